@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(script_dir, "..", "Preprocessing"))
+sys.path.append(os.path.join(script_dir, "..", "Training"))
+sys.path.append(os.path.join(script_dir, "..", "Decoding"))
+from classifier import FilterBankClassifier, TemplateClassifier
+from epoching import epoch_view
+from filters import FilterBank, SubBandFilterBank
+from raw_data import read_legacy_session, read_session, write_session
+from ring_buffer import RingBuffer
+from trca import TRCA, EnsembleTRCA
+
+SAMPLE_RATE = 250
+N_CHANNELS = 8
+# Session shapes of the two training stages: 1-second trials, every target shown 6 times
+SCENARIOS = {
+    "stage1": {"seconds": 48, "targets": 8},
+    "stage2": {"seconds": 192, "targets": 32},
+}
+
+
+def synthetic_session(seconds, n_targets, seed=0):
+    '''
+    A session shaped like a real recording: every 1-second trial is its target's
+    code, mixed into the channels with random gains, plus noise.
+
+    :returns tuple: (channels, samples) float32 data and the target of each trial
+    '''
+    rng = np.random.default_rng(seed)
+    codes = rng.standard_normal((n_targets, SAMPLE_RATE))
+    targets = np.tile(np.arange(n_targets), seconds // n_targets)
+    rng.shuffle(targets)
+    signal = codes[targets].reshape(-1)
+    gains = rng.standard_normal((N_CHANNELS, 1))
+    data = gains * signal + 2 * rng.standard_normal((N_CHANNELS, len(signal)))
+    return data.astype(np.float32), targets
+
+
+def write_legacy_session(path, data, targets):
+    '''
+    Write a session in the text format of older versions of collect_training_data.py.
+    '''
+    with open(path, "w") as file:
+        file.write(",".join(map(str, targets)) + "\n")
+        np.savetxt(file, data.T, delimiter=",", fmt="%.6f")
+
+
+def measure(function, repeat):
+    '''
+    :returns tuple: best wall-clock time over `repeat` calls (s) and peak traced memory of one call (bytes)
+    '''
+    function()      # Warm up caches (filter designs, FFT plans, imports)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def benchmarks(scenario, workdir):
+    '''
+    Build the benchmarks of one scenario.
+
+    :returns dict: name -> zero-argument function to time
+    '''
+    data, targets = synthetic_session(scenario["seconds"], scenario["targets"])
+    txt_path = os.path.join(workdir, "session.txt")
+    bin_path = os.path.join(workdir, "session.bin")
+    write_legacy_session(txt_path, data, targets)
+    write_session(bin_path, data, SAMPLE_RATE, list(range(N_CHANNELS)), targets.tolist())
+
+    onsets = np.arange(len(targets)) * SAMPLE_RATE
+    epochs = np.ascontiguousarray(epoch_view(data, onsets, SAMPLE_RATE), dtype=np.float64)
+    filter_bank = FilterBank(SAMPLE_RATE)
+    sub_bands = SubBandFilterBank(SAMPLE_RATE)
+    filtered = filter_bank.filter(epochs)
+    classifier = TemplateClassifier().fit(filtered, targets)
+    fb_classifier = FilterBankClassifier(sub_bands.bands).fit(sub_bands.filter(epochs), targets)
+    window = filtered[0]
+
+    # One second of 100 ms hops, each followed by a read of the newest 1-second window
+    hops = np.ascontiguousarray(data[:, :SAMPLE_RATE], dtype=np.float64).reshape(N_CHANNELS, 10, -1).transpose(1, 0, 2)
+    ring_buffer = RingBuffer(N_CHANNELS, SAMPLE_RATE)
+    ring_buffer.write(filtered[0])
+
+    def windows_concatenate():
+        window = filtered[0]
+        for hop in hops:
+            window = np.concatenate([window, hop], axis=1)[:, -SAMPLE_RATE:]
+        return window
+
+    def windows_ring_buffer():
+        for hop in hops:
+            ring_buffer.write(hop)
+            window = ring_buffer.window(SAMPLE_RATE)
+        return window
+
+    def classify_session():
+        trained = TemplateClassifier().fit(filter_bank.filter(epochs), targets)
+        return [trained.predict(trial) for trial in filter_bank.filter(epochs)]
+
+    return {
+        "load_genfromtxt": lambda: np.genfromtxt(txt_path, delimiter=",", skip_header=1),
+        "load_legacy_txt": lambda: read_legacy_session(txt_path),
+        "load_binary": lambda: np.array(read_session(bin_path)[1]),     # copy, so the samples are read rather than just mapped
+        "filter_epochs": lambda: filter_bank.filter(epochs),
+        "filter_continuous": lambda: filter_bank.filter(data),
+        "filter_sub_bands": lambda: sub_bands.filter(epochs),
+        "trca_fit_transform": lambda: TRCA().fit_transform(filtered),
+        "ensemble_trca_fit": lambda: EnsembleTRCA().fit(filtered, targets),
+        "windows_concatenate": windows_concatenate,
+        "windows_ring_buffer": windows_ring_buffer,
+        "correlate_window": lambda: classifier.lag_scores(window),
+        "predict_window": lambda: classifier.predict(window),
+        "predict_window_filter_bank": lambda: fb_classifier.predict(sub_bands.filter(window)),
+        "classify_session": classify_session,
+    }
+
+
+def run(scenario_names, repeat, only=None):
+    '''
+    :returns dict: scenario -> benchmark -> {"seconds": ..., "peak_bytes": ...}
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in scenario_names:
+            results[name] = {}
+            for bench, function in benchmarks(SCENARIOS[name], workdir).items():
+                if only and not any(pattern in bench for pattern in only):
+                    continue
+                seconds, peak = measure(function, repeat)
+                results[name][bench] = {"seconds": seconds, "peak_bytes": peak}
+    return results
+
+
+def report(results, baseline=None):
+    '''
+    Print the results as a table, with the change relative to a baseline run if given.
+    '''
+    for scenario, benches in results.items():
+        shape = SCENARIOS[scenario]
+        print(f"\n{scenario}: {N_CHANNELS} channels x {SAMPLE_RATE} Hz x {shape['seconds']} s, {shape['targets']} targets")
+        print(f"{'benchmark':<28}{'time (ms)':>12}{'peak (MiB)':>12}" + (f"{'vs baseline':>14}" if baseline else ""))
+        for bench, result in benches.items():
+            line = f"{bench:<28}{result['seconds'] * 1000:>12.3f}{result['peak_bytes'] / 2 ** 20:>12.2f}"
+            previous = (baseline or {}).get(scenario, {}).get(bench)
+            if previous:
+                line += f"{result['seconds'] / previous['seconds']:>13.2f}x"
+            print(line)
+
+
+def file_args():
+    '''
+    Parse through the arguments for running this file.
+
+    :returns Namespace: the detected arguments
+    '''
+    parser = argparse.ArgumentParser(description="Time the preprocessing and decoding hot paths on synthetic sessions")
+    parser.add_argument("--scenario", choices=list(SCENARIOS), nargs="+", default=list(SCENARIOS), help="Session shapes to run")
+    parser.add_argument("--only", nargs="+", help="Only run benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed repetitions per benchmark (the best is reported)")
+    parser.add_argument("--save", help="Save the results to this .json file")
+    parser.add_argument("--compare", help="Results .json of an earlier run to compare against")
+    return parser.parse_args()
+
+
+def main():
+    args = file_args()
+    results = run(args.scenario, args.repeat, args.only)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
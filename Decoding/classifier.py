@@ -0,0 +1,614 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Preprocessing"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Stimuli", "Generic"))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Training"))
+from codeBank import loadCodeBank
+from raw_data import read_header
+from trainingStimuli import stage1TargetPositions, stage2TargetPositions, targetTriangles
+from filters import FILTER_BANK_BANDS
+from trca import TRCA, EnsembleTRCA
+
+NOISE_SEQUENCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Stimuli", "Generic", "noiseSequences.npy")
+STIMULUS_FRAME_RATE = 60
+
+
+def resample_codes(noise_sequence, sample_rate=250, frame_rate=STIMULUS_FRAME_RATE):
+    '''
+    Resample per-frame stimulus codes to the EEG sampling rate. Each frame's
+    value is held for as long as the frame is on screen.
+
+    :param noise_sequence: array of shape (codes, frames) or (codes, frames, 1), e.g. noiseSequences.npy
+    :param sample_rate: EEG sampling rate in Hz
+    :param frame_rate: refresh rate the codes are displayed at
+    :returns np.ndarray: array of shape (codes, samples) covering one code period
+    '''
+    codes = np.asarray(noise_sequence, dtype=np.float64).reshape(len(noise_sequence), -1)
+    n_frames = codes.shape[1]
+    n_samples = int(round(n_frames / frame_rate * sample_rate))
+    frames = (np.arange(n_samples) * frame_rate // sample_rate).astype(int) % n_frames
+    return codes[:, frames] - 1     # Same -1 offset the stimuli apply before display
+
+
+def load_code_templates(sample_rate=250, path=NOISE_SEQUENCE_FILE):
+    '''
+    :returns np.ndarray: the stimulus noise codes as (codes, samples) templates
+    '''
+    return resample_codes(loadCodeBank(path)[0], sample_rate)
+
+
+def code_bank_hash(path=NOISE_SEQUENCE_FILE):
+    '''
+    :returns str: hash of the code bank the stimuli display, see Stimuli/Generic/codeBank.py
+    '''
+    return loadCodeBank(path)[1]["sha256"]
+
+
+def session_code_bank(session_paths):
+    '''
+    Hash of the code bank the stimuli displayed during recorded sessions, as logged in
+    their headers. Sessions that did not log one (legacy .txt sessions and sessions
+    recorded before the hash was logged) are taken to have shown noiseSequences.npy.
+
+    :param session_paths: session files recorded with the same codes
+    :returns str: the code bank hash
+    :raises ValueError: if the sessions were recorded with different code banks
+    '''
+    banks = {(None if path.endswith(".txt") else read_header(path).get("code_bank")) or code_bank_hash()
+             for path in session_paths}
+    if len(banks) > 1:
+        raise ValueError("The sessions were recorded with different code banks")
+    return banks.pop()
+
+
+def stage_target_codes(n_targets):
+    '''
+    Code index driving each target of the training layouts. Triangle k of the
+    stimuli displays code k, so a target's code is the triangle it is drawn on,
+    worked out from the layout the stimuli use (see Stimuli/Generic/trainingStimuli.py).
+
+    :param n_targets: 8 for Stage 1 or 32 for Stage 2
+    :returns np.ndarray: code index of every target
+    '''
+    if n_targets == 8:
+        return targetTriangles(stage1TargetPositions())
+    if n_targets == 32:
+        return targetTriangles(stage2TargetPositions())
+    raise ValueError(f"No training layout has {n_targets} targets")
+
+
+def _fold(x, period):
+    '''
+    Fold the last axis onto one period by summing x[n] into bin n mod period, so
+    a circular correlation of the folded signal equals the correlation of the
+    whole signal against a periodic template.
+    '''
+    length = x.shape[-1]
+    padded = np.zeros(x.shape[:-1] + (-(-length // period) * period,))
+    padded[..., :length] = x
+    return padded.reshape(x.shape[:-1] + (-1, period)).sum(axis=-2)
+
+
+class TemplateClassifier:
+    '''
+    cVEP template-matching classifier.
+
+    A TRCA spatial filter is fitted on all training epochs from per-target
+    statistics (see `TRCA.partial_fit`), and each target's template is the
+    filtered average of its epochs (or, for targets without
+    training data, its resampled stimulus code). The codes repeat every period,
+    so a window taken at any phase matches some circular lag of its template.
+    `scores` evaluates the normalized cross-correlation at every lag against
+    every template in one batched FFT, so its cost does not grow with the
+    number of Python calls per target.
+
+    With `ensemble=True` the spatial filter is an ensemble TRCA: the filters of
+    every target, each fitted on its own trials in one batched solve, are
+    stacked and every window and template is projected onto all of them.
+    '''
+    def __init__(self, n_components=1, ensemble=False):
+        self.n_components = n_components
+        self.ensemble = ensemble
+        self.trca = EnsembleTRCA(n_components) if ensemble else TRCA(n_components)
+        self.targets = None
+        self.templates = None
+        self.code_targets = {}      # target -> code template, for targets without training epochs
+        self.code_bank = None       # Hash of the code bank the classifier was trained with, if known
+
+    def fit(self, epochs, targets, code_templates=None, target_codes=None):
+        '''
+        Train from scratch, discarding any earlier blocks.
+
+        :param epochs: filtered array of shape (trials, channels, samples), one code period per epoch
+        :param targets: target index of each trial
+        :param code_templates: optional (codes, samples) stimulus codes, see `load_code_templates`
+        :param target_codes: code index of every target (0..n_targets-1); targets never seen in
+                             training use their code as the template
+        :returns TemplateClassifier: this instance
+        '''
+        n_samples = np.shape(epochs)[-1]
+        trained = np.unique(targets)
+        self.code_targets = {}
+        for target in range(len(target_codes) if target_codes is not None else 0):
+            if target in trained:
+                continue
+            if code_templates is None:
+                raise ValueError(f"Target {target} has no training epochs and no code template")
+            self.code_targets[target] = np.asarray(code_templates[target_codes[target]][:n_samples], dtype=np.float64)
+        self.trca = EnsembleTRCA(self.n_components) if self.ensemble else TRCA(self.n_components)
+        return self.partial_fit(epochs, targets)
+
+    def partial_fit(self, epochs, targets):
+        '''
+        Fold a new block of training epochs into the classifier. The TRCA keeps
+        per-target statistics of every earlier block (see `TRCA.partial_fit`), so
+        only the new epochs are processed before the filters and templates are
+        re-derived. A target that gets its first epochs here stops using its
+        code template.
+
+        :param epochs: filtered array of shape (trials, channels, samples), one code period per epoch
+        :param targets: target index of each trial
+        :returns TemplateClassifier: this instance
+        '''
+        self.trca.partial_fit(epochs, targets)
+        means = self.trca.target_means()
+        self.targets = np.array(sorted(set(means) | set(self.code_targets)))
+        n_components = self.trca.filters.shape[1]
+        self._set_templates(np.stack([self.trca.transform(means[target]) if target in means else
+                                      np.tile(self.code_targets[target], (n_components, 1))
+                                      for target in self.targets]))
+        return self
+
+    def _set_templates(self, templates):
+        '''
+        Store the templates together with the spectra `scores` needs: the
+        template itself, its square (for per-lag norms) and its sum.
+        '''
+        self.templates = templates
+        self.period = templates.shape[-1]
+        self._template_fft = np.fft.rfft(templates, axis=-1)                  # (targets, components, freqs)
+        self._template_sq_fft = np.fft.rfft(templates ** 2, axis=-1).sum(axis=1)
+        self._template_sum_fft = self._template_fft.sum(axis=1)
+
+    @property
+    def n_channels(self):
+        '''
+        :returns int: number of EEG channels the spatial filters were fitted on
+        '''
+        return self.trca.filters.shape[0]
+
+    def lag_scores(self, window):
+        '''
+        Normalized cross-correlation of a window with every template at every
+        circular lag.
+
+        :param window: filtered array of shape (channels, samples)
+        :returns np.ndarray: array of shape (targets, period); entry [k, lag] is the
+                             Pearson correlation of the window with template k shifted by lag
+        '''
+        projected = self.trca.transform(window)                     # (components, samples)
+        return self._folded_lag_scores(_fold(projected, self.period), _fold(np.ones(projected.shape[-1]), self.period),
+                                       projected.sum(), (projected ** 2).sum(), projected.size)
+
+    def _folded_lag_scores(self, folded, folded_ones, window_sum, window_sq, n):
+        '''
+        `lag_scores` from sums of the projected window: its folded samples
+        (components, period), the folded count of samples per bin (period,), and
+        the sum, sum of squares and number of its values. These sums can be
+        accumulated incrementally as samples arrive (see `DynamicStopping`).
+        '''
+        window_fft = np.conj(np.fft.rfft(folded, axis=-1))
+        ones_fft = np.conj(np.fft.rfft(folded_ones))
+
+        # Sums over the window of w*T, T and T^2 at every lag, for all targets at once
+        cross = np.fft.irfft((self._template_fft * window_fft).sum(axis=1), n=self.period)
+        template_sum = np.fft.irfft(self._template_sum_fft * ones_fft, n=self.period)
+        template_sq = np.fft.irfft(self._template_sq_fft * ones_fft, n=self.period)
+
+        covariance = cross - window_sum * template_sum / n
+        template_var = np.maximum(template_sq - template_sum ** 2 / n, 0)
+        window_var = max(window_sq - window_sum ** 2 / n, 0)
+        norms = np.sqrt(template_var * window_var)
+        return covariance / np.where(norms > 0, norms, np.inf)
+
+    def scores(self, window):
+        '''
+        :param window: filtered array of shape (channels, samples)
+        :returns np.ndarray: best correlation of each target's template over all lags
+        '''
+        return self.lag_scores(window).max(axis=1)
+
+    def predict(self, window):
+        '''
+        :param window: filtered array of shape (channels, samples)
+        :returns tuple: the best target index and its correlation
+        '''
+        scores = self.scores(window)
+        best = int(np.argmax(scores))
+        return int(self.targets[best]), float(scores[best])
+
+    def save(self, path):
+        '''
+        Save the fitted filters and templates to an .npz file, together with the
+        TRCA statistics so a loaded classifier can still be updated with `partial_fit`.
+        '''
+        np.savez(path, **self._model_arrays())
+
+    def _model_arrays(self):
+        code_targets = sorted(self.code_targets)
+        arrays = {"filters": self.trca.filters, "targets": self.targets, "templates": self.templates,
+                  "ensemble": self.ensemble, "code_bank": self.code_bank or "", "code_targets": np.array(code_targets, dtype=int),
+                  "code_templates": (np.stack([self.code_targets[target] for target in code_targets]) if code_targets
+                                     else np.zeros((0, self.period)))}
+        if self.trca.counts:
+            arrays.update({"trca_" + key: value for key, value in self.trca.statistics().items()})
+        return arrays
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load a classifier saved with `save`. Models saved without TRCA statistics
+        can decode but not be updated.
+        '''
+        with np.load(path) as model:
+            classifier = cls._from_model(model)
+            classifier.targets = model["targets"]
+            classifier._set_templates(model["templates"])
+        return classifier
+
+    @classmethod
+    def _from_model(cls, model):
+        '''
+        A classifier with the filters, TRCA statistics, code templates and code bank of a loaded model.
+        '''
+        ensemble = "ensemble" in model.files and bool(model["ensemble"])
+        if "trca_counts" in model.files:
+            n_components = int(model["trca_n_components"])
+            classifier = cls(None if n_components < 0 else n_components, ensemble)
+            classifier.trca.restore_statistics({key[len("trca_"):]: model[key] for key in model.files
+                                                if key.startswith("trca_")})
+        else:
+            classifier = cls(model["filters"].shape[1], ensemble)
+        classifier.trca.filters = model["filters"]
+        if "code_targets" in model.files:
+            classifier.code_targets = dict(zip(model["code_targets"].tolist(), model["code_templates"]))
+        classifier._load_code_bank(model)
+        return classifier
+
+    def _load_code_bank(self, model):
+        if "code_bank" in model.files:
+            self.code_bank = str(model["code_bank"]) or None
+
+    def check_code_bank(self, code_bank=None):
+        '''
+        :param code_bank: hash of the code bank being decoded, e.g. from a session header (see
+                          `session_code_bank`), defaults to the hash of noiseSequences.npy
+        :returns bool: False if the classifier is known to have been trained with different codes
+        '''
+        return self.code_bank is None or self.code_bank == (code_bank or code_bank_hash())
+
+
+class DynamicStopping:
+    '''
+    Decide a trial as soon as the evidence is strong enough instead of waiting
+    out a fixed window.
+
+    Samples are fed in short increments from the start of a trial. The
+    projected samples are added into the folded sums `lag_scores` works from,
+    so each increment costs the same whatever the elapsed time, rather than
+    re-correlating the whole window. After every increment the margin between
+    the best and second-best target's correlation is compared with a threshold
+    (see `calibrate_stopping`); the trial also ends once `max_samples` have
+    been seen.
+    '''
+    def __init__(self, classifier, threshold, min_samples=0, max_samples=None):
+        self.classifier = classifier
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.max_samples = max_samples if max_samples is not None else classifier.period
+        self.reset()
+
+    def reset(self):
+        '''
+        Start a new trial.
+        '''
+        n_components = self.classifier.trca.filters.shape[1]
+        self.folded = np.zeros((n_components, self.classifier.period))
+        self.folded_ones = np.zeros(self.classifier.period)
+        self.window_sum = 0.0
+        self.window_sq = 0.0
+        self.n_samples = 0
+
+    def update(self, chunk):
+        '''
+        Add the next samples of the trial.
+
+        :param chunk: filtered array of shape (channels, new_samples)
+        :returns tuple: (target, confidence, margin, decided)
+        '''
+        projected = self.classifier.trca.transform(chunk)
+        bins = (self.n_samples + np.arange(projected.shape[-1])) % self.classifier.period
+        np.add.at(self.folded, (slice(None), bins), projected)
+        np.add.at(self.folded_ones, bins, 1)
+        self.window_sum += projected.sum()
+        self.window_sq += (projected ** 2).sum()
+        self.n_samples += projected.shape[-1]
+
+        scores = self.classifier._folded_lag_scores(self.folded, self.folded_ones, self.window_sum, self.window_sq,
+                                                    self.n_samples * projected.shape[0]).max(axis=1)
+        best, second = np.argsort(scores)[::-1][:2] if len(scores) > 1 else (np.argmax(scores), None)
+        margin = float(scores[best] - (scores[second] if second is not None else 0))
+        decided = (self.n_samples >= self.max_samples or
+                   (self.n_samples >= self.min_samples and margin >= self.threshold))
+        return int(self.classifier.targets[best]), float(scores[best]), margin, decided
+
+
+def calibrate_stopping(classifier, epochs, targets, step_samples, target_accuracy=0.95, min_samples=0):
+    '''
+    Choose the smallest margin threshold whose early decisions on held-out
+    epochs are at least `target_accuracy` accurate, by replaying every epoch in
+    increments of `step_samples`. Trials that never pass the threshold are
+    decided on the whole epoch.
+
+    :param classifier: fitted TemplateClassifier (not fitted on `epochs`)
+    :param epochs: filtered held-out array of shape (trials, channels, samples)
+    :param targets: target index of each trial
+    :param step_samples: samples per increment, e.g. 25 for 100 ms at 250Hz
+    :param target_accuracy: accuracy the early decisions must reach
+    :param min_samples: samples to wait before any decision
+    :returns tuple: the threshold, its accuracy and the mean decision time in samples
+    '''
+    epochs = np.asarray(epochs)
+    steps = np.arange(step_samples, epochs.shape[-1] + 1, step_samples)
+    margins = np.empty((len(epochs), len(steps)))
+    correct = np.empty((len(epochs), len(steps)), dtype=bool)
+    for trial, epoch in enumerate(epochs):
+        stopper = DynamicStopping(classifier, np.inf, max_samples=epochs.shape[-1])
+        for i, start in enumerate(steps - step_samples):
+            target, _, margins[trial, i], _ = stopper.update(epoch[:, start:start + step_samples])
+            correct[trial, i] = target == targets[trial]
+    margins[:, steps < min_samples] = -np.inf
+    margins[:, -1] = np.inf          # The whole epoch is always a decision
+
+    best = (np.inf, correct[:, -1].mean(), float(steps[-1]))
+    for threshold in np.unique(margins[np.isfinite(margins)])[::-1]:
+        stop = np.argmax(margins >= threshold, axis=1)
+        accuracy = correct[np.arange(len(epochs)), stop].mean()
+        if accuracy < target_accuracy:
+            break
+        best = (float(threshold), float(accuracy), float(steps[stop].mean()))
+    return best
+
+
+def lags_to_samples(lags, code_frames, period):
+    '''
+    Convert target lags from stimulus frames to EEG samples.
+
+    :param lags: lag of each target in frames, e.g. from codeSequences.circularShiftCodes
+    :param code_frames: length of the code in frames
+    :param period: length of the code period in samples
+    :returns np.ndarray: lag of each target in samples
+    '''
+    return np.round(np.asarray(lags) * period / code_frames).astype(int) % period
+
+
+class CircularShiftClassifier(TemplateClassifier):
+    '''
+    Template matching for targets that share one code per family at different
+    circular lags (m-sequence or Gold code stimuli).
+
+    Each training epoch is rolled back by its target's lag, so every trial of a
+    family contributes to a single template. Memory and training time therefore
+    depend on the number of code families rather than the number of targets, and
+    a target's score is read from the family's lag scores at the target's lag.
+    Lags are only meaningful relative to the code phase, so decoding needs the
+    phase of the window (samples since the code last started).
+    '''
+    def fit(self, epochs, targets, target_lags, target_families=None, phases=None):
+        '''
+        Train from scratch, discarding any earlier blocks.
+
+        :param epochs: filtered array of shape (trials, channels, period), one full code period per epoch
+        :param targets: target index of each trial
+        :param target_lags: lag in samples of every target (see `lags_to_samples`)
+        :param target_families: code family of every target, all 0 when every target shares one code
+        :param phases: code phase in samples at the start of each epoch, all 0 when epochs start with the code
+        :returns CircularShiftClassifier: this instance
+        '''
+        self.target_lags = np.asarray(target_lags, dtype=int) % np.shape(epochs)[-1]
+        self.target_families = (np.zeros(len(self.target_lags), dtype=int) if target_families is None
+                                 else np.asarray(target_families, dtype=int))
+        self.targets = np.arange(len(self.target_lags))
+        self.trca = EnsembleTRCA(self.n_components) if self.ensemble else TRCA(self.n_components)
+        return self.partial_fit(epochs, targets, phases)
+
+    def partial_fit(self, epochs, targets, phases=None):
+        '''
+        Fold a new block of training epochs into the classifier, keeping the
+        target lags and families given to `fit`. Epochs are aligned by their
+        target's lag before they are added to the TRCA statistics, which are
+        kept per code family.
+
+        :param epochs: filtered array of shape (trials, channels, period), one full code period per epoch
+        :param targets: target index of each trial
+        :param phases: code phase in samples at the start of each epoch, all 0 when epochs start with the code
+        :returns CircularShiftClassifier: this instance
+        '''
+        epochs = np.asarray(epochs, dtype=np.float64)
+        targets = np.asarray(targets)
+        period = epochs.shape[-1]
+        phases = np.zeros(len(epochs), dtype=int) if phases is None else np.asarray(phases, dtype=int)
+
+        # Undo each target's lag so epochs of one family line up sample for sample
+        indices = (np.arange(period) - phases[:, None] + self.target_lags[targets][:, None]) % period
+        aligned = np.take_along_axis(epochs, indices[:, None, :], axis=-1)
+
+        self.trca.partial_fit(aligned, self.target_families[targets])  # An ensemble has one filter set per family
+        means = self.trca.target_means()
+        missing = sorted(set(range(self.target_families.max() + 1)) - set(means))
+        if missing:
+            raise ValueError(f"Code families {missing} have no training epochs")
+        self._set_templates(np.stack([self.trca.transform(means[family]) for family in sorted(means)]))
+        return self
+
+    def scores(self, window, phase=0):
+        '''
+        :param window: filtered array of shape (channels, samples)
+        :param phase: code phase in samples at the first sample of the window
+        :returns np.ndarray: correlation of the window with every target's lagged template
+        '''
+        lag_scores = self.lag_scores(window)        # (families, period), one FFT batch for all targets
+        return lag_scores[self.target_families, (phase - self.target_lags) % self.period]
+
+    def predict(self, window, phase=0):
+        '''
+        :param window: filtered array of shape (channels, samples)
+        :param phase: code phase in samples at the first sample of the window
+        :returns tuple: the best target index and its correlation
+        '''
+        scores = self.scores(window, phase)
+        best = int(np.argmax(scores))
+        return best, float(scores[best])
+
+    def save(self, path):
+        np.savez(path, target_lags=self.target_lags, target_families=self.target_families, **self._model_arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as model:
+            classifier = cls._from_model(model)
+            classifier.target_lags = model["target_lags"]
+            classifier.target_families = model["target_families"]
+            classifier.targets = np.arange(len(classifier.target_lags))
+            classifier._set_templates(model["templates"])
+        return classifier
+
+
+def filter_bank_weights(n_bands, a=1.25, b=0.25):
+    '''
+    Standard filter-bank weights n^-a + b, emphasising the lower sub-bands.
+
+    :param n_bands: number of sub-bands
+    :returns np.ndarray: weight of each sub-band
+    '''
+    return np.arange(1, n_bands + 1) ** -a + b
+
+
+class FilterBankClassifier:
+    '''
+    Filter-bank template matching: one `TemplateClassifier` per sub-band (see
+    `SubBandFilterBank`), whose lag scores are combined as a weighted sum before
+    taking the best lag of each target.
+
+    Sub-bands are scored in a thread pool (the FFTs and matrix products
+    release the GIL). With a time budget the bands are collected in order of
+    weight and bands that have not finished by the deadline are left out, with
+    the weights of the finished ones renormalized, so the decision time stays
+    bounded as bands are added. The first band is always used. A band still
+    scoring an earlier window sits out the next one instead of queueing behind
+    it, so at most one window per band is ever in flight.
+    '''
+    def __init__(self, bands=FILTER_BANK_BANDS, n_components=1, ensemble=False, weights=None, workers=None):
+        self.bands = [tuple(band) for band in bands]
+        self.classifiers = [TemplateClassifier(n_components, ensemble) for _ in self.bands]
+        self.weights = filter_bank_weights(len(self.bands)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.code_bank = None
+        self.skipped_bands = 0      # Bands left out of decisions because they missed the deadline
+        self._executor = ThreadPoolExecutor(workers or len(self.bands))
+        self._in_flight = [None] * len(self.bands)  # Latest future of every band, possibly still running
+
+    @property
+    def targets(self):
+        return self.classifiers[0].targets
+
+    @property
+    def n_channels(self):
+        return self.classifiers[0].n_channels
+
+    def fit(self, band_epochs, targets, code_templates=None, target_codes=None):
+        '''
+        :param band_epochs: array of shape (bands, trials, channels, samples), e.g. from `SubBandFilterBank.filter`
+        :param targets: target index of each trial
+        :param code_templates: see `TemplateClassifier.fit`
+        :param target_codes: see `TemplateClassifier.fit`
+        :returns FilterBankClassifier: this instance
+        '''
+        for classifier, epochs in zip(self.classifiers, band_epochs):
+            classifier.fit(epochs, targets, code_templates, target_codes)
+        return self
+
+    def scores(self, band_window, time_budget=None):
+        '''
+        :param band_window: array of shape (bands, channels, samples)
+        :param time_budget: seconds to wait for the bands after the first, or None to use every band
+        :returns np.ndarray: best weighted correlation of each target over all lags
+        '''
+        start = time.perf_counter()
+        futures = []
+        for band, (classifier, window) in enumerate(zip(self.classifiers, band_window)):
+            if self._in_flight[band] is not None and not self._in_flight[band].done():
+                futures.append(None)    # Still busy with an earlier window that missed its deadline
+                continue
+            self._in_flight[band] = self._executor.submit(classifier.lag_scores, window)
+            futures.append(self._in_flight[band])
+        total = self.weights[0] * futures[0].result()
+        weight = self.weights[0]
+        timeout = None if time_budget is None else max(0.0, time_budget - (time.perf_counter() - start))
+        done, _ = wait([future for future in futures[1:] if future is not None], timeout=timeout)
+        for band, future in enumerate(futures[1:], start=1):
+            if future in done:
+                total += self.weights[band] * future.result()
+                weight += self.weights[band]
+            else:
+                if future is not None:
+                    future.cancel()
+                self.skipped_bands += 1
+        return (total / weight).max(axis=1)
+
+    def predict(self, band_window, time_budget=None):
+        '''
+        :param band_window: array of shape (bands, channels, samples)
+        :param time_budget: see `scores`
+        :returns tuple: the best target index and its weighted correlation
+        '''
+        scores = self.scores(band_window, time_budget)
+        best = int(np.argmax(scores))
+        return int(self.targets[best]), float(scores[best])
+
+    _load_code_bank = TemplateClassifier._load_code_bank
+    check_code_bank = TemplateClassifier.check_code_bank
+
+    def save(self, path):
+        np.savez(path, bands=np.array(self.bands), weights=self.weights, targets=self.targets,
+                 filters=np.stack([classifier.trca.filters for classifier in self.classifiers]),
+                 templates=np.stack([classifier.templates for classifier in self.classifiers]),
+                 code_bank=self.code_bank or "")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as model:
+            classifier = cls(model["bands"].tolist(), model["filters"].shape[-1], weights=model["weights"])
+            for band, band_classifier in enumerate(classifier.classifiers):
+                band_classifier.trca.filters = model["filters"][band]
+                band_classifier.targets = model["targets"]
+                band_classifier._set_templates(model["templates"][band])
+            classifier._load_code_bank(model)
+        return classifier
+
+
+def load_classifier(path):
+    '''
+    Load a model saved by any of the classifiers in this file.
+    '''
+    with np.load(path) as model:
+        keys = model.files
+    if "bands" in keys:
+        return FilterBankClassifier.load(path)
+    if "target_lags" in keys:
+        return CircularShiftClassifier.load(path)
+    return TemplateClassifier.load(path)
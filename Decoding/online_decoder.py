@@ -0,0 +1,457 @@
+import argparse
+import os
+import socket
+import struct
+import sys
+import time
+
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(script_dir, "..", "Preprocessing"))
+sys.path.append(os.path.join(script_dir, "..", "Training"))
+from classifier import (CircularShiftClassifier, DynamicStopping, FilterBankClassifier, TemplateClassifier,
+                        calibrate_stopping, code_bank_hash, load_classifier, load_code_templates, session_code_bank,
+                        stage_target_codes)
+from epoching import epoch_trials, session_trials
+from filters import FILTER_BANK_BANDS, FilterBank, SubBandFilterBank
+from raw_data import read_session
+from ring_buffer import AllocationMeter, RingBuffer
+from shared_stream import STREAM_NAME, SharedStreamReader
+
+# Decisions are published as single UDP datagrams on the loopback interface:
+# target index, confidence and the wall-clock time the decision was made.
+DECISION_HOST = "127.0.0.1"
+DECISION_PORT = 50708
+_DECISION = struct.Struct("<idd")
+
+
+class BoardSource:
+    '''
+    New samples from a streaming BrainFlow board.
+    '''
+    def __init__(self, board, eeg_channels, timestamp_channel):
+        self.board = board
+        self.eeg_channels = eeg_channels
+        self.timestamp_channel = timestamp_channel
+
+    def read(self):
+        '''
+        :returns tuple: (channels, new_samples) array and the timestamp of its newest sample (None if empty)
+        '''
+        data = self.board.get_board_data()
+        if data.shape[1] == 0:
+            return data[self.eeg_channels], None
+        return data[self.eeg_channels], data[self.timestamp_channel, -1]
+
+
+class SharedStreamSource:
+    '''
+    New samples published in shared memory by a running collect_training_data.py,
+    so the decoder can follow a recording without opening the board itself.
+    '''
+    def __init__(self, name=STREAM_NAME):
+        self.reader = SharedStreamReader(name)
+        self.sample_rate = self.reader.sample_rate
+        self.n_channels = self.reader.rows - 1     # The last row holds the timestamps
+
+    def read(self):
+        '''
+        :returns tuple: (channels, new_samples) view and the timestamp of its newest sample (None if empty)
+        '''
+        samples = self.reader.read()
+        if samples.shape[1] == 0:
+            return samples[:-1], None
+        return samples[:-1], samples[-1, -1]
+
+    @property
+    def exhausted(self):
+        return self.reader.closed and self.reader.available == 0
+
+
+class ReplaySource:
+    '''
+    Replay a recorded session as if it were arriving from a board. In real time
+    each read returns the samples that would have arrived since the last one;
+    otherwise every read returns the next `chunk_seconds` of samples immediately,
+    and the decoder does not wait between reads.
+    '''
+    def __init__(self, session_path, realtime=True, chunk_seconds=0.1):
+        header, self.data = read_session(session_path)
+        self.sample_rate = header["sample_rate"]
+        self.realtime = realtime
+        self.chunk_samples = max(1, int(round(chunk_seconds * self.sample_rate)))
+        self.position = 0
+        self.start_time = None
+
+    def read(self):
+        '''
+        :returns tuple: (channels, new_samples) array and the time its newest sample "arrived" (None if empty)
+        '''
+        now = time.time()
+        if self.start_time is None:
+            self.start_time = now
+        if self.realtime:
+            end = min(int((now - self.start_time) * self.sample_rate), self.data.shape[1])
+        else:
+            end = min(self.position + self.chunk_samples, self.data.shape[1])
+        chunk = np.asarray(self.data[:, self.position:end])
+        self.position = end
+        if chunk.shape[1] == 0:
+            return chunk, None
+        arrival = self.start_time + end / self.sample_rate if self.realtime else now
+        return chunk, arrival
+
+    @property
+    def exhausted(self):
+        return self.position >= self.data.shape[1]
+
+
+class LatencyHistogram:
+    '''
+    Fixed-bin histogram of decision latencies, cheap enough to update every hop.
+    '''
+    def __init__(self, max_ms=500, bin_ms=1):
+        self.bin_ms = bin_ms
+        self.counts = np.zeros(int(max_ms / bin_ms) + 1, dtype=np.int64)    # Last bin collects overflow
+
+    def add(self, latency_s):
+        self.counts[min(int(latency_s * 1000 / self.bin_ms), len(self.counts) - 1)] += 1
+
+    def percentile(self, q):
+        '''
+        :param q: percentile in [0, 100]
+        :returns float: upper edge (ms) of the bin holding the q-th percentile
+        '''
+        total = self.counts.sum()
+        if total == 0:
+            return float("nan")
+        index = np.searchsorted(np.cumsum(self.counts), q / 100 * total)
+        return (index + 1) * self.bin_ms
+
+    def summary(self):
+        return (f"{self.counts.sum()} decisions, latency p50 {self.percentile(50)} ms, "
+                f"p95 {self.percentile(95)} ms, p99 {self.percentile(99)} ms")
+
+
+class DecisionPublisher:
+    '''
+    Publish decoded targets to any listening process (e.g. the gaze-controlled stimulus).
+    '''
+    def __init__(self, host=DECISION_HOST, port=DECISION_PORT):
+        self.address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def publish(self, target, confidence, decision_time):
+        self._socket.sendto(_DECISION.pack(target, confidence, decision_time), self.address)
+
+    def close(self):
+        self._socket.close()
+
+
+class OnlineDecoder:
+    '''
+    Sliding-window cVEP decoder.
+
+    Every `hop` seconds the decoder pulls whatever samples have arrived, filters
+    them causally, appends them to a ring buffer and classifies a view of its
+    last `window` seconds, so overlapping windows are never copied. A source that has fallen behind is drained in one
+    read, so a slow hop is followed by a decision on the newest data instead of
+    a backlog of stale ones; decisions slower than `latency_budget` are counted.
+
+    With a `SubBandFilterBank` the window holds every sub-band, and a
+    `FilterBankClassifier` is given whatever is left of the latency budget to
+    score the bands in, so adding bands cannot push decisions past it.
+
+    With a `DynamicStopping` the decoder works trial by trial instead: every
+    hop's samples are added to the current trial's evidence, and a decision is
+    made (and the next trial started) as soon as the stopper is confident.
+    '''
+    def __init__(self, classifier, source, sample_rate, n_channels, publisher=None, window=1.0, hop=0.1,
+                 latency_budget=0.2, filter_bank=None, stopper=None, allocation_meter=None):
+        if isinstance(classifier, CircularShiftClassifier):
+            # Its scores depend on the code phase of the window, which the sources do not report
+            raise ValueError("A CircularShiftClassifier needs the code phase of every window, "
+                             "which the online decoder does not track")
+        if classifier.n_channels != n_channels:
+            raise ValueError(f"The classifier was trained on {classifier.n_channels} channels "
+                             f"but the source has {n_channels}")
+        self.classifier = classifier
+        self.source = source
+        self.publisher = publisher
+        self.hop = hop
+        self.latency_budget = latency_budget
+        self.filter_bank = filter_bank if filter_bank is not None else FilterBank(fs=sample_rate)
+        n_bands = (len(self.filter_bank.bands),) if isinstance(self.filter_bank, SubBandFilterBank) else ()
+        self.window_samples = int(round(window * sample_rate))
+        self.buffer = RingBuffer(n_bands + (n_channels,), self.window_samples)
+        self.histogram = LatencyHistogram()
+        self.late_decisions = 0
+        self.stopper = stopper
+        self.allocation_meter = allocation_meter    # Measures every step when given
+        self.decision_samples = []      # Trial length at every dynamic-stopping decision
+
+    def step(self):
+        '''
+        Consume new samples and, once the window is full, make a decision.
+
+        :returns tuple: (target, confidence, latency) or None if no decision was made
+        '''
+        chunk, newest_time = self.source.read()
+        if newest_time is None:
+            return None
+
+        filtered = self.filter_bank.filter_chunk(chunk)
+        if self.stopper is not None:
+            target, confidence, _, decided = self.stopper.update(filtered)
+            if not decided:
+                return None
+            self.decision_samples.append(self.stopper.n_samples)
+            self.stopper.reset()
+            return self._decide(target, confidence, newest_time)
+
+        self.buffer.write(filtered)
+        if len(self.buffer) < self.window_samples:
+            return None
+
+        window = self.buffer.window(self.window_samples)
+        if isinstance(self.classifier, FilterBankClassifier):
+            remaining = self.latency_budget - (time.time() - newest_time)
+            target, confidence = self.classifier.predict(window, time_budget=remaining)
+        else:
+            target, confidence = self.classifier.predict(window)
+        return self._decide(target, confidence, newest_time)
+
+    def _decide(self, target, confidence, newest_time):
+        '''
+        Publish a decision and record its latency.
+        '''
+        decision_time = time.time()
+        if self.publisher is not None:
+            self.publisher.publish(target, confidence, decision_time)
+
+        latency = decision_time - newest_time
+        self.histogram.add(latency)
+        if latency > self.latency_budget:
+            self.late_decisions += 1
+        return target, confidence, latency
+
+    def run(self, duration=None, verbose=True):
+        '''
+        Decode until `duration` seconds have passed, a replayed session ends or
+        the process is interrupted.
+        '''
+        end_time = None if duration is None else time.monotonic() + duration
+        next_hop = time.monotonic()
+        try:
+            while end_time is None or time.monotonic() < end_time:
+                if self.allocation_meter is not None:
+                    with self.allocation_meter:
+                        decision = self.step()
+                else:
+                    decision = self.step()
+                if decision is not None and verbose:
+                    print(f"Target {decision[0]} (confidence {decision[1]:.3f}, latency {decision[2] * 1000:.1f} ms)")
+                if getattr(self.source, "exhausted", False):
+                    break
+                if getattr(self.source, "realtime", True):  # A fast replay has its next hop ready at once
+                    next_hop += self.hop
+                    time.sleep(max(0.0, next_hop - time.monotonic()))
+        except KeyboardInterrupt:
+            pass
+        print(self.histogram.summary() + f", {self.late_decisions} over the {self.latency_budget * 1000:.0f} ms budget")
+        if self.allocation_meter is not None:
+            print("Decoder steps:", self.allocation_meter.summary())
+        if isinstance(self.classifier, FilterBankClassifier):
+            print(f"{self.classifier.skipped_bands} sub-band scores left out to stay within the budget")
+        if self.decision_samples:
+            print(f"Dynamic stopping: mean trial length {np.mean(self.decision_samples):.0f} samples")
+
+
+def load_training_epochs(session_paths, filter_bank):
+    '''
+    Filter every training session as one continuous recording, then cut it into epochs.
+    The recording is filtered causally, like the live stream in `OnlineDecoder.step`,
+    so the templates carry the same phase delay as the windows they are matched against.
+
+    :param session_paths: training session files
+    :param filter_bank: FilterBank, or SubBandFilterBank for epochs of every sub-band
+    :returns tuple: filtered epochs of shape ([bands,] trials, channels, samples) and the target of each trial
+    '''
+    epochs, targets = [], []
+    for path in session_paths:
+        data, sample_rate, onsets, session_targets = session_trials(path)
+        filter_bank.reset()
+        filtered = filter_bank.filter_chunk(data)
+        filter_bank.reset()
+        session_epochs, session_targets = epoch_trials(filtered, sample_rate, onsets, session_targets)
+        epochs.append(session_epochs)
+        targets.append(session_targets)
+    return np.concatenate(epochs, axis=-3), np.concatenate(targets)
+
+
+def train_classifier(session_paths, filter_bank, ensemble=False):
+    '''
+    Fit a TemplateClassifier (or, with a SubBandFilterBank, a FilterBankClassifier)
+    on the epochs of one or more training sessions. Targets of the layout that
+    never appear in the sessions fall back to their resampled stimulus code.
+    The classifier records the code bank the sessions logged in their headers.
+    '''
+    code_bank = session_code_bank(session_paths)
+    epochs, targets = load_training_epochs(session_paths, filter_bank)
+    n_targets = 8 if targets.max() < 8 else 32
+    if len(np.unique(targets)) < n_targets and code_bank != code_bank_hash():
+        # The fallback templates come from noiseSequences.npy, not from the codes the sessions showed
+        raise ValueError("Targets missing from the training sessions need their codes, but the sessions "
+                         "showed a different code bank than Stimuli/Generic/noiseSequences.npy")
+    if isinstance(filter_bank, SubBandFilterBank):
+        classifier = FilterBankClassifier(filter_bank.bands, ensemble=ensemble)
+    else:
+        classifier = TemplateClassifier(ensemble=ensemble)
+    classifier.fit(epochs, targets, load_code_templates(filter_bank.fs), stage_target_codes(n_targets))
+    classifier.code_bank = code_bank
+    return classifier
+
+
+def calibrate_from_sessions(session_paths, filter_bank, step_samples, target_accuracy=0.95, ensemble=False):
+    '''
+    Calibrate the dynamic-stopping threshold on training sessions: a classifier
+    fitted on every other trial replays the remaining trials, so the threshold
+    is not tuned on the trials the templates were built from.
+
+    :returns tuple: the threshold, its accuracy and the mean decision time in samples
+    '''
+    epochs, targets = load_training_epochs(session_paths, filter_bank)
+    n_targets = 8 if targets.max() < 8 else 32
+    classifier = TemplateClassifier(ensemble=ensemble)
+    classifier.fit(epochs[::2], targets[::2], load_code_templates(filter_bank.fs), stage_target_codes(n_targets))
+    return calibrate_stopping(classifier, epochs[1::2], targets[1::2], step_samples, target_accuracy)
+
+
+def file_args():
+    '''
+    Parse through the arguments for running this file.
+
+    :returns Namespace: the detected arguments
+    '''
+    parser = argparse.ArgumentParser(description="Online cVEP decoder")
+
+    model = parser.add_mutually_exclusive_group(required=True)
+    model.add_argument("--model", help="Classifier saved with TemplateClassifier.save (.npz)")
+    model.add_argument("--train", nargs="+", help="Training sessions to fit the classifier on")
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--cyton", action="store_true", help="Decode live from the OpenBCI Cyton")
+    source.add_argument("--synthetic", action="store_true", help="Decode live from BrainFlow's synthetic board")
+    source.add_argument("--replay", help="Replay a recorded session file")
+    source.add_argument("--shared", nargs="?", const=STREAM_NAME,
+                        help="Decode the samples a running collect_training_data.py publishes in shared memory")
+
+    parser.add_argument("--fast", action="store_true", help="Replay as fast as possible instead of in real time")
+    parser.add_argument("--save-model", help="Save the trained classifier to this .npz file")
+    parser.add_argument("--ensemble", action="store_true", help="Train with one TRCA filter per target (ensemble TRCA)")
+    parser.add_argument("--bands", type=int, choices=range(1, len(FILTER_BANK_BANDS) + 1),
+                        help="Train a filter-bank classifier on this many sub-bands")
+    parser.add_argument("--window", type=float, default=1.0, help="Window length in seconds")
+    parser.add_argument("--hop-ms", type=float, default=100, help="Milliseconds between decisions")
+    parser.add_argument("--budget-ms", type=float, default=200, help="End-to-end latency budget in milliseconds")
+    parser.add_argument("--duration", type=float, help="Stop after this many seconds")
+    parser.add_argument("--measure-allocations", action="store_true",
+                        help="Measure the memory every decoder step allocates with tracemalloc (slows decoding down)")
+    stopping = parser.add_mutually_exclusive_group()
+    stopping.add_argument("--stop-threshold", type=float,
+                          help="Decide each trial early once the best target leads the second by this correlation margin")
+    stopping.add_argument("--calibrate-stopping", type=float, metavar="ACCURACY",
+                          help="Calibrate the early-stopping threshold on the training sessions for this accuracy")
+    return parser.parse_args()
+
+
+def main():
+    args = file_args()
+    board = None
+
+    if args.replay:
+        source = ReplaySource(args.replay, realtime=not args.fast, chunk_seconds=args.hop_ms / 1000)
+        sample_rate = source.sample_rate
+        n_channels = source.data.shape[0]
+    elif args.shared:
+        source = SharedStreamSource(args.shared)
+        sample_rate = source.sample_rate
+        n_channels = source.n_channels
+    else:
+        from brainflow.board_shim import BoardShim, BoardIds, BrainFlowInputParams
+
+        params = BrainFlowInputParams()
+        board_id = BoardIds.SYNTHETIC_BOARD if args.synthetic else BoardIds.CYTON_BOARD
+        if args.cyton:
+            from collect_training_data import find_cyton_port
+            params.serial_port = find_cyton_port()
+        eeg_channels = BoardShim.get_eeg_channels(board_id.value)   # Every EEG channel, as collect_training_data.py records
+        board = BoardShim(board_id, params)
+        board.prepare_session()
+        board.start_stream()
+        source = BoardSource(board, eeg_channels, BoardShim.get_timestamp_channel(board_id.value))
+        sample_rate = BoardShim.get_sampling_rate(board_id.value)
+        n_channels = len(eeg_channels)
+
+    # Everything after the board is opened runs inside try, so it is released however the decoder exits
+    try:
+        run_decoder(args, source, sample_rate, n_channels)
+    finally:
+        if board is not None:
+            board.stop_stream()
+            board.release_session()
+
+
+def run_decoder(args, source, sample_rate, n_channels):
+    '''
+    Load or train the classifier, set up dynamic stopping if asked for, and decode from `source`.
+    '''
+    if args.model:
+        classifier = load_classifier(args.model)
+        if isinstance(classifier, CircularShiftClassifier):
+            sys.exit("Online decoding with a CircularShiftClassifier is not supported, it needs the code phase of every window")
+    else:
+        filter_bank = (SubBandFilterBank(sample_rate, FILTER_BANK_BANDS[:args.bands]) if args.bands
+                       else FilterBank(fs=sample_rate))
+        classifier = train_classifier(args.train, filter_bank, args.ensemble)
+        if args.save_model:
+            classifier.save(args.save_model)
+
+    # A replayed session logs the codes it showed; live stimuli show noiseSequences.npy unless given a code seed
+    if not classifier.check_code_bank(session_code_bank([args.replay]) if args.replay else None):
+        print("Warning: the model was trained with different stimulus codes than "
+              + ("the replayed session showed" if args.replay else "Stimuli/Generic/noiseSequences.npy"))
+    if classifier.n_channels != n_channels:
+        sys.exit(f"The model was trained on {classifier.n_channels} EEG channels but the source has {n_channels}; "
+                 "train and decode with the same board")
+
+    if isinstance(classifier, FilterBankClassifier):
+        filter_bank = SubBandFilterBank(sample_rate, classifier.bands)
+    else:
+        filter_bank = FilterBank(fs=sample_rate)
+
+    stopper = None
+    threshold = args.stop_threshold
+    if (threshold is not None or args.calibrate_stopping is not None) and isinstance(classifier, FilterBankClassifier):
+        sys.exit("Dynamic stopping is not supported with a filter-bank classifier")
+    if args.calibrate_stopping is not None:
+        if not args.train:
+            sys.exit("--calibrate-stopping needs training sessions (--train)")
+        threshold, accuracy, samples = calibrate_from_sessions(args.train, filter_bank,
+                                                               int(round(args.hop_ms / 1000 * sample_rate)),
+                                                               args.calibrate_stopping, args.ensemble)
+        print(f"Stopping threshold {threshold:.3f}: {accuracy:.1%} accurate, "
+              f"mean decision after {samples / sample_rate * 1000:.0f} ms")
+    if threshold is not None:
+        stopper = DynamicStopping(classifier, threshold, max_samples=int(round(args.window * sample_rate)))
+
+    decoder = OnlineDecoder(classifier, source, sample_rate, n_channels, publisher=DecisionPublisher(),
+                            window=args.window, hop=args.hop_ms / 1000, latency_budget=args.budget_ms / 1000,
+                            filter_bank=filter_bank, stopper=stopper,
+                            allocation_meter=AllocationMeter() if args.measure_allocations else None)
+    decoder.run(args.duration)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Session files are read with the helpers that write them
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Training"))
+from raw_data import read_legacy_session, read_session, read_trial_onsets
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+EPOCH_CACHE_VERSION = 1     # Bump when the epoching logic changes to invalidate old caches
+LEGACY_SAMPLE_RATE = 250
+
+
+def epoch_view(data, onsets, epoch_samples):
+    '''
+    Slice a continuous recording into epochs starting at the given samples.
+
+    When the onsets are evenly spaced (trials shown back to back) the result is
+    a strided view of `data` and nothing is copied; irregular onsets need a
+    gather, which copies.
+
+    :param data: array of shape (..., channels, samples), e.g. (bands, channels, samples) after a filter bank
+    :param onsets: sample index at which each epoch starts
+    :param epoch_samples: length of each epoch in samples
+    :returns np.ndarray: array of shape (..., trials, channels, epoch_samples)
+    '''
+    onsets = np.asarray(onsets, dtype=np.intp)
+    if len(onsets) and (onsets.min() < 0 or onsets.max() + epoch_samples > data.shape[-1]):
+        raise ValueError("Epochs extend past the ends of the recording")
+
+    windows = sliding_window_view(data, epoch_samples, axis=-1)     # (..., channels, windows, epoch_samples) view
+    steps = np.diff(onsets)
+    if len(onsets) == 1 or (len(onsets) > 1 and steps[0] > 0 and np.all(steps == steps[0])):
+        step = steps[0] if len(steps) else 1
+        windows = windows[..., onsets[0]::step, :][..., :len(onsets), :]
+    else:
+        windows = windows[..., onsets, :]
+    return np.moveaxis(windows, -2, -3)
+
+
+def epoch_trials(data, sample_rate, onsets, targets, epoch_seconds=1.0, offset_seconds=0.0):
+    '''
+    Cut a continuous recording into one epoch per trial, dropping trials cut
+    short by the start or end of the recording. Filter `data` before epoching
+    it, so the filter's edge transients fall at the ends of the recording
+    rather than at the ends of every epoch.
+
+    :param data: array of shape (..., channels, samples)
+    :param sample_rate: sample rate of `data` in Hz
+    :param onsets: sample index of each trial's onset, see `session_trials`
+    :param targets: target index of each trial
+    :param epoch_seconds: length of each epoch
+    :param offset_seconds: shift of each epoch relative to its trial onset
+    :returns tuple: epochs of shape (..., trials, channels, samples) and the target index of each kept trial
+    '''
+    epoch_samples = int(round(epoch_seconds * sample_rate))
+    onsets = np.asarray(onsets) + int(round(offset_seconds * sample_rate))
+    complete = (onsets >= 0) & (onsets + epoch_samples <= data.shape[-1])
+    return epoch_view(data, onsets[complete], epoch_samples), np.asarray(targets)[complete]
+
+
+def session_trials(session_path):
+    '''
+    Load a session and locate its trials.
+
+    Trial onsets come from the marker channel of binary sessions. Legacy .txt
+    sessions (and binary sessions recorded without markers) are assumed to show
+    one 1-second trial after another from the first sample.
+
+    :param session_path: a binary session file or a legacy .txt session
+    :returns tuple: (channels, samples) data, sample rate, onset sample indices and target indices
+    '''
+    if session_path.endswith(".txt"):
+        stimulus_indices, data = read_legacy_session(session_path)
+        sample_rate = LEGACY_SAMPLE_RATE
+        trial_onsets = None
+    else:
+        header, data = read_session(session_path)
+        stimulus_indices = header["stimulus_indices"]
+        sample_rate = header["sample_rate"]
+        trial_onsets = read_trial_onsets(session_path)
+
+    if trial_onsets is None or len(trial_onsets[0]) == 0:
+        targets = np.asarray(stimulus_indices, dtype=int)
+        onsets = np.arange(len(targets)) * int(round(sample_rate))
+    else:
+        onsets, targets = trial_onsets
+    return data, sample_rate, onsets, targets
+
+
+def file_hash(path, chunk_size=1 << 20):
+    '''
+    SHA-256 of a file's contents, read in chunks.
+
+    :returns str: the hex digest
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_paths(session_path, cache_dir, params):
+    key = hashlib.sha256(json.dumps(dict(params, source=file_hash(session_path)), sort_keys=True).encode()).hexdigest()[:24]
+    stem = os.path.splitext(os.path.basename(session_path))[0]
+    prefix = os.path.join(cache_dir, f"{stem}_{key}")
+    return prefix + "_epochs.npy", prefix + "_targets.npy"
+
+
+def load_epochs(session_path, epoch_seconds=1.0, offset_seconds=0.0, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Build the (trials, channels, samples) tensor of a session, reusing a cached
+    copy when the session file and epoching parameters have not changed.
+
+    :param session_path: a binary session file or a legacy .txt session
+    :param epoch_seconds: length of each epoch
+    :param offset_seconds: shift of each epoch relative to its trial onset
+    :param cache_dir: directory for cached epochs, or None to disable caching
+    :returns tuple: float32 epochs of shape (trials, channels, samples) and the target index of each trial
+    '''
+    params = {
+        "version": EPOCH_CACHE_VERSION,
+        "epoch_seconds": float(epoch_seconds),
+        "offset_seconds": float(offset_seconds),
+    }
+    if cache_dir is not None:
+        epochs_path, targets_path = _cache_paths(session_path, cache_dir, params)
+        if os.path.exists(epochs_path) and os.path.exists(targets_path):
+            return np.load(epochs_path, mmap_mode="r"), np.load(targets_path)
+
+    data, sample_rate, onsets, targets = session_trials(session_path)
+    epochs, targets = epoch_trials(data, sample_rate, onsets, targets, epoch_seconds, offset_seconds)
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(epochs_path, np.ascontiguousarray(epochs, dtype=np.float32))
+        np.save(targets_path, targets)
+    return epochs, targets
+
+
+def epochs_by_target(epochs, targets):
+    '''
+    Group epochs by the target that was shown.
+
+    :param epochs: array of shape (trials, channels, samples)
+    :param targets: target index of each trial
+    :returns dict: target index -> array of shape (trials_of_target, channels, samples)
+    '''
+    targets = np.asarray(targets)
+    return {int(target): epochs[targets == target] for target in np.unique(targets)}
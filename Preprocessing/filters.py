@@ -0,0 +1,132 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import butter, iirnotch, sosfilt, sosfilt_zi, sosfiltfilt, tf2sos
+
+CYTON_SAMPLE_RATE = 250
+# Sub-bands of filter-bank TRCA: the lower edge steps up by 8 Hz while the upper edge stays fixed,
+# so each band isolates the harmonics above its lower edge
+FILTER_BANK_BANDS = ((4, 100), (12, 100), (20, 100), (28, 100), (36, 100))
+
+
+@lru_cache(maxsize=None)
+def design_sos(fs, lowcut, highcut, notch_freq=None, order=4, quality_factor=30):
+    '''
+    Design a Butterworth bandpass (optionally followed by a notch) as one cascade
+    of second-order sections. Designs are cached, so each (fs, band) pair is only
+    computed once per process.
+
+    :param fs: sampling rate in Hz
+    :param lowcut: lower edge of the passband in Hz
+    :param highcut: upper edge of the passband in Hz
+    :param notch_freq: mains frequency to remove in Hz, or None for no notch
+    :param order: order of the Butterworth prototype
+    :param quality_factor: quality factor of the notch
+    :returns np.ndarray: SOS array of shape (sections, 6), shared by every caller so do not modify it
+    '''
+    sos = butter(order, [lowcut, highcut], btype="band", output="sos", fs=fs)
+    if notch_freq is not None and notch_freq < fs / 2:
+        b, a = iirnotch(notch_freq, quality_factor, fs=fs)
+        sos = np.vstack([sos, tf2sos(b, a)])
+    return sos
+
+
+class FilterBank:
+    '''
+    Bandpass + notch filter for EEG tensors of any shape, filtering along the last
+    (sample) axis.
+
+    `filter` is zero-phase (`sosfiltfilt`) and meant for recorded data, e.g. a
+    whole (trials, channels, samples) tensor in one call. `filter_chunk` is
+    causal (`sosfilt`) and keeps the filter state between calls, so consecutive
+    chunks of a live stream are filtered as if they were one signal.
+    '''
+    def __init__(self, fs=CYTON_SAMPLE_RATE, lowcut=4, highcut=100, notch_freq=60, order=4, quality_factor=30):
+        self.fs = fs
+        self.sos = design_sos(float(fs), float(lowcut), float(highcut),
+                              None if notch_freq is None else float(notch_freq), order, float(quality_factor))
+        self._zi = None
+
+    def filter(self, data):
+        '''
+        Zero-phase filter data along its last axis.
+
+        :param data: array of shape (..., samples)
+        :returns np.ndarray: filtered array of the same shape
+        '''
+        return sosfiltfilt(self.sos, data, axis=-1)
+
+    def filter_chunk(self, chunk):
+        '''
+        Causally filter the next chunk of a stream, continuing from the state
+        left by the previous chunk. The first chunk starts from the steady state
+        of its first sample to avoid a start-up transient.
+
+        :param chunk: array of shape (..., chunk_samples); the leading shape must not change between calls
+        :returns np.ndarray: filtered chunk of the same shape
+        '''
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if self._zi is None or self._zi.shape[1:-1] != chunk.shape[:-1]:
+            zi = sosfilt_zi(self.sos)
+            self._zi = zi.reshape((zi.shape[0],) + (1,) * (chunk.ndim - 1) + (2,)) * chunk[..., :1]
+        filtered, self._zi = sosfilt(self.sos, chunk, axis=-1, zi=self._zi)
+        return filtered
+
+    def reset(self):
+        '''
+        Forget the causal filter state, e.g. before starting a new stream.
+        '''
+        self._zi = None
+
+
+class SubBandFilterBank:
+    '''
+    Several bandpass filters applied to the same signal, as used by filter-bank
+    TRCA. Outputs stack the sub-bands along a new leading axis.
+
+    Each sub-band is one SOS cascade run over the whole (..., samples) tensor.
+    `filter` hands the sub-bands to a thread pool, since SciPy's SOS filters
+    release the GIL and can use several cores. `filter_chunk` runs them in turn,
+    as a chunk of a stream is too short for threads to pay off.
+    '''
+    def __init__(self, fs=CYTON_SAMPLE_RATE, bands=FILTER_BANK_BANDS, notch_freq=60, order=4, quality_factor=30,
+                 workers=None):
+        self.fs = fs
+        self.bands = [tuple(band) for band in bands]
+        self.filter_banks = [FilterBank(fs, lowcut, highcut, notch_freq, order, quality_factor)
+                             for lowcut, highcut in self.bands]
+        self._executor = ThreadPoolExecutor(workers or len(self.bands))
+
+    def filter(self, data):
+        '''
+        Zero-phase filter data into every sub-band.
+
+        :param data: array of shape (..., samples)
+        :returns np.ndarray: array of shape (bands, ..., samples)
+        '''
+        data = np.asarray(data, dtype=np.float64)
+        output = np.empty((len(self.filter_banks),) + data.shape)
+
+        def run(band):
+            output[band] = self.filter_banks[band].filter(data)
+
+        list(self._executor.map(run, range(len(self.filter_banks))))
+        return output
+
+    def filter_chunk(self, chunk):
+        '''
+        Causally filter the next chunk of a stream into every sub-band, see `FilterBank.filter_chunk`.
+
+        :param chunk: array of shape (..., chunk_samples)
+        :returns np.ndarray: array of shape (bands, ..., chunk_samples)
+        '''
+        chunk = np.asarray(chunk, dtype=np.float64)
+        output = np.empty((len(self.filter_banks),) + chunk.shape)
+        for band, filter_bank in enumerate(self.filter_banks):
+            output[band] = filter_bank.filter_chunk(chunk)
+        return output
+
+    def reset(self):
+        for filter_bank in self.filter_banks:
+            filter_bank.reset()
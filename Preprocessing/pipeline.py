@@ -0,0 +1,205 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from epoching import epoch_trials, file_hash, session_trials
+from filters import FilterBank
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Training"))
+from raw_data import SESSION_EXTENSION
+
+TRAINING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Training")
+DEFAULT_SESSION_DIRS = [os.path.join(TRAINING_DIR, "Stage1RawData"), os.path.join(TRAINING_DIR, "Stage2RawData")]
+DEFAULT_OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "sessions")
+PIPELINE_VERSION = 2        # Bump when process_session changes to invalidate old outputs
+DEFAULT_PARAMS = {
+    "epoch_seconds": 1.0,
+    "offset_seconds": 0.0,
+    "lowcut": 4.0,
+    "highcut": 100.0,
+    "notch_freq": 60.0,
+    "order": 4,
+}
+
+
+def discover_sessions(paths):
+    '''
+    Find every session file (binary or legacy .txt) among the given files and directories.
+
+    :param paths: session files and/or directories to search recursively
+    :returns list: sorted session paths
+    '''
+    sessions = []
+    for path in paths:
+        if os.path.isfile(path):
+            sessions.append(path)
+            continue
+        for root, _, files in os.walk(path):
+            sessions.extend(os.path.join(root, name) for name in files
+                            if name.endswith(SESSION_EXTENSION) or name.endswith(".txt"))
+    return sorted(os.path.abspath(session) for session in sessions)
+
+
+def output_paths(session_path, output_dir):
+    '''
+    :returns tuple: the .npz features file and .json manifest of a session. The stem
+                    includes the parent directory and the session's extension, so sessions
+                    of different stages, or a .txt session and its converted .bin, never collide.
+    '''
+    stage = os.path.basename(os.path.dirname(os.path.abspath(session_path)))
+    stem = os.path.join(output_dir, f"{stage}_{os.path.basename(session_path)}")
+    return stem + ".npz", stem + ".json"
+
+
+def _params_key(params):
+    return hashlib.sha256(json.dumps(dict(params, version=PIPELINE_VERSION), sort_keys=True).encode()).hexdigest()[:24]
+
+
+def is_up_to_date(session_path, output_dir, params):
+    '''
+    Check whether a session's outputs were produced from its current contents with
+    the same parameters. Sessions whose size and modification time are unchanged
+    are trusted without re-hashing; otherwise the contents are hashed.
+
+    :returns bool: True if the session can be skipped
+    '''
+    features_path, manifest_path = output_paths(session_path, output_dir)
+    if not (os.path.exists(features_path) and os.path.exists(manifest_path)):
+        return False
+    with open(manifest_path, "r") as file:
+        manifest = json.load(file)
+    if manifest.get("params_key") != _params_key(params):
+        return False
+    stat = os.stat(session_path)
+    if manifest.get("size") == stat.st_size and manifest.get("mtime_ns") == stat.st_mtime_ns:
+        return True
+    return manifest.get("source") == file_hash(session_path)
+
+
+def process_session(session_path, output_dir, params):
+    '''
+    Load, filter, epoch and extract features of one session, and save them.
+    The continuous recording is filtered before it is cut into epochs.
+
+    Features are the filtered float32 epochs, their targets, and the average
+    filtered epoch of every target (the per-session templates TRCA is fitted on).
+
+    :param session_path: a binary session file or a legacy .txt session
+    :param output_dir: directory for the per-session outputs
+    :param params: epoching and filter parameters, see DEFAULT_PARAMS
+    :returns tuple: the session path and the number of trials
+    '''
+    stat = os.stat(session_path)
+    data, sample_rate, onsets, targets = session_trials(session_path)
+    filter_bank = FilterBank(sample_rate, params["lowcut"], params["highcut"], params["notch_freq"], params["order"])
+    epochs, targets = epoch_trials(filter_bank.filter(data), sample_rate, onsets, targets,
+                                   params["epoch_seconds"], params["offset_seconds"])
+    epochs = epochs.astype(np.float32)
+
+    target_ids = np.unique(targets)
+    templates = np.stack([epochs[targets == target].mean(axis=0) for target in target_ids]) if len(epochs) else epochs
+
+    features_path, manifest_path = output_paths(session_path, output_dir)
+    np.savez(features_path, epochs=epochs, targets=targets, target_ids=target_ids, templates=templates,
+             sample_rate=sample_rate)
+    # The manifest is written last, so an interrupted run is redone rather than trusted
+    with open(manifest_path, "w") as file:
+        json.dump({
+            "session": session_path,
+            "source": file_hash(session_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "params": params,
+            "params_key": _params_key(params),
+            "trials": int(len(epochs)),
+        }, file, indent=2)
+    return session_path, len(epochs)
+
+
+def run_pipeline(session_paths, output_dir=DEFAULT_OUTPUT_DIR, params=None, workers=None, force=False):
+    '''
+    Process every session that is missing or out of date, one session per worker process.
+    A session that fails is reported and does not stop the others.
+
+    :param session_paths: session files to process
+    :param output_dir: directory for the per-session outputs
+    :param params: epoching and filter parameters, defaults to DEFAULT_PARAMS
+    :param workers: number of processes, defaults to the number of CPUs
+    :param force: reprocess sessions even if they are up to date
+    :returns tuple: lists of processed, skipped and failed session paths
+    '''
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    os.makedirs(output_dir, exist_ok=True)
+    pending = [path for path in session_paths if force or not is_up_to_date(path, output_dir, params)]
+    skipped = sorted(set(session_paths) - set(pending))
+    processed, failed = [], []
+    print(f"{len(pending)} sessions to process, {len(skipped)} up to date")
+    if not pending:
+        return processed, skipped, failed
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(process_session, path, output_dir, params): path for path in pending}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                _, trials = future.result()
+                processed.append(path)
+                print(f"[{len(processed) + len(failed)}/{len(pending)}] {os.path.basename(path)}: {trials} trials")
+            except Exception as e:
+                failed.append(path)
+                print(f"[{len(processed) + len(failed)}/{len(pending)}] {os.path.basename(path)} failed: {e}")
+    print(f"Processed {len(processed)} sessions in {time.perf_counter() - start:.1f} s, {len(failed)} failed")
+    return processed, skipped, failed
+
+
+def load_features(session_path, output_dir=DEFAULT_OUTPUT_DIR):
+    '''
+    :returns dict: the arrays saved by `process_session` for a session
+    '''
+    with np.load(output_paths(session_path, output_dir)[0]) as features:
+        return {name: features[name] for name in features.files}
+
+
+def file_args():
+    '''
+    Parse through the arguments for running this file.
+
+    :returns Namespace: the detected arguments
+    '''
+    parser = argparse.ArgumentParser(description="Preprocess recorded sessions in parallel")
+    parser.add_argument("paths", nargs="*", default=DEFAULT_SESSION_DIRS,
+                        help="Session files or directories (defaults to Training/Stage1RawData and Stage2RawData)")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_DIR, help="Directory for the per-session outputs")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (defaults to the number of CPUs)")
+    parser.add_argument("--force", action="store_true", help="Reprocess sessions that are already up to date")
+    parser.add_argument("--epoch-seconds", type=float, default=DEFAULT_PARAMS["epoch_seconds"], help="Epoch length")
+    parser.add_argument("--offset-seconds", type=float, default=DEFAULT_PARAMS["offset_seconds"], help="Epoch shift from trial onset")
+    parser.add_argument("--lowcut", type=float, default=DEFAULT_PARAMS["lowcut"], help="Lower edge of the passband in Hz")
+    parser.add_argument("--highcut", type=float, default=DEFAULT_PARAMS["highcut"], help="Upper edge of the passband in Hz")
+    parser.add_argument("--notch", type=float, default=DEFAULT_PARAMS["notch_freq"], help="Mains frequency to remove in Hz")
+    return parser.parse_args()
+
+
+def main():
+    args = file_args()
+    params = {
+        "epoch_seconds": args.epoch_seconds,
+        "offset_seconds": args.offset_seconds,
+        "lowcut": args.lowcut,
+        "highcut": args.highcut,
+        "notch_freq": args.notch,
+    }
+    _, _, failed = run_pipeline(discover_sessions(args.paths), args.output, params, args.workers, args.force)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
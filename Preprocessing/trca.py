@@ -0,0 +1,254 @@
+import numpy as np
+from scipy.linalg import eigh
+
+
+def _as_trials(eeg_data):
+    '''
+    Coerce EEG data into a (trials, channels, samples) array with each trial
+    centered along the sample axis.
+
+    :param eeg_data: array of shape (channels, samples) or (trials, channels, samples)
+    :returns np.ndarray: the centered, three-dimensional trial array
+    '''
+    eeg_data = np.asarray(eeg_data, dtype=np.float64)
+    if eeg_data.ndim == 2:
+        eeg_data = eeg_data[np.newaxis, :, :]
+    if eeg_data.ndim != 3:
+        raise ValueError(f"Expected 2D or 3D EEG data, got shape {eeg_data.shape}")
+    return eeg_data - eeg_data.mean(axis=-1, keepdims=True)
+
+
+def lagged_covariance(eeg_data, lag=1):
+    '''
+    Sum of the lagged cross-covariance x[:, i] x[:, i + lag]^T over every
+    sample of every trial, computed with a single batched contraction.
+
+    :param eeg_data: centered array of shape (trials, channels, samples)
+    :param lag: sample offset between the two factors
+    :returns np.ndarray: symmetric (channels, channels) matrix
+    '''
+    lagged = np.einsum('tcs,tds->cd', eeg_data[:, :, :-lag], eeg_data[:, :, lag:])
+    return (lagged + lagged.T) / 2  # Symmetric part, required by the eigensolver
+
+
+def total_covariance(eeg_data):
+    '''
+    Sum of X_h X_h^T over all trials (the Q matrix of TRCA).
+
+    :param eeg_data: centered array of shape (trials, channels, samples)
+    :returns np.ndarray: symmetric (channels, channels) matrix
+    '''
+    return np.einsum('tcs,tds->cd', eeg_data, eeg_data)
+
+
+def batched_generalized_eigh(S, Q):
+    '''
+    Solve a stack of generalized symmetric eigenproblems S_k w = lambda Q_k w at
+    once. Each Q_k = L_k L_k^T is factored with a batched Cholesky, the problems
+    are reduced to standard ones L_k^-1 S_k L_k^-T, and those are solved by a
+    single batched `np.linalg.eigh`, so there is no Python loop over k.
+
+    :param S: array of shape (k, channels, channels), symmetric
+    :param Q: array of shape (k, channels, channels), symmetric positive definite
+    :returns tuple: eigenvalues (k, channels) and eigenvectors (k, channels, channels), both descending
+    '''
+    L = np.linalg.cholesky(Q)
+    half = np.linalg.solve(L, S)                                    # L^-1 S
+    reduced = np.linalg.solve(L, half.transpose(0, 2, 1))           # L^-1 S L^-T (S is symmetric)
+    eigvals, eigvecs = np.linalg.eigh((reduced + reduced.transpose(0, 2, 1)) / 2)
+    eigvecs = np.linalg.solve(L.transpose(0, 2, 1), eigvecs)        # Back to w = L^-T v
+    return eigvals[:, ::-1], eigvecs[:, :, ::-1]
+
+
+class TRCA:
+    '''
+    Task-related component analysis.
+
+    Spatial filters maximise the reproducibility of the signal across trials by
+    solving the generalized symmetric eigenproblem S w = lambda Q w. With
+    repeated trials S is the inter-trial covariance, summed over targets; when
+    no target has more than one trial (e.g. a single continuous recording, as
+    in the preprocessing notebook) S falls back to the lag-1 cross-covariance.
+
+    S and Q are built from sufficient statistics kept per target (trial count,
+    sum of the centered trials, sum of X X^T), so `partial_fit` can fold in a new
+    block of trials without the earlier ones and only re-solves the eigenproblem.
+    Trials given without targets are pooled, as if they all showed one target.
+    '''
+    def __init__(self, n_components=None):
+        self.n_components = n_components
+        self.filters = None
+        self.eigvals = None
+        self.counts = {}        # target -> number of trials
+        self.trial_sums = {}    # target -> (channels, samples) sum of the centered trials
+        self.covariances = {}   # target -> (channels, channels) sum of X X^T (its share of Q)
+        self.lagged = None      # Summed lag-1 covariance, the S of a single trial
+
+    def fit(self, eeg_data, targets=None):
+        '''
+        Compute the spatial filters, discarding any earlier statistics.
+
+        :param eeg_data: array of shape (channels, samples) or (trials, channels, samples)
+        :param targets: target of each trial, or None to pool every trial
+        :returns TRCA: this instance, with `filters` of shape (channels, components)
+        '''
+        self.counts, self.trial_sums, self.covariances, self.lagged = {}, {}, {}, None
+        return self.partial_fit(eeg_data, targets)
+
+    def partial_fit(self, eeg_data, targets=None):
+        '''
+        Add trials to the statistics and re-solve for the spatial filters.
+
+        :param eeg_data: array of shape (channels, samples) or (trials, channels, samples)
+        :param targets: target of each trial, or None to pool every trial
+        :returns TRCA: this instance, with `filters` of shape (channels, components)
+        '''
+        eeg_data = _as_trials(eeg_data)
+        targets = np.zeros(len(eeg_data), dtype=int) if targets is None else np.asarray(targets)
+        if self.trial_sums and next(iter(self.trial_sums.values())).shape != eeg_data.shape[1:]:
+            raise ValueError(f"Trials of shape {eeg_data.shape[1:]} do not match the fitted statistics")
+
+        for target in np.unique(targets):
+            trials = eeg_data[targets == target]
+            target = target.item()
+            self.counts[target] = self.counts.get(target, 0) + len(trials)
+            self.trial_sums[target] = self.trial_sums.get(target, 0) + trials.sum(axis=0)
+            self.covariances[target] = self.covariances.get(target, 0) + total_covariance(trials)
+        lagged = lagged_covariance(eeg_data)
+        self.lagged = lagged if self.lagged is None else self.lagged + lagged
+        return self._solve()
+
+    def _solve(self):
+        '''
+        Solve the eigenproblem from the current statistics.
+        '''
+        Q = sum(self.covariances.values())
+        if max(self.counts.values()) > 1:
+            # Inter-trial covariance of each target: (sum_h X_h)(sum_h X_h)^T - sum_h X_h X_h^T,
+            # which is zero for a target with a single trial
+            S = sum(trial_sum @ trial_sum.T - self.covariances[target]
+                    for target, trial_sum in self.trial_sums.items())
+        else:
+            S = self.lagged
+
+        # eigh returns ascending eigenvalues, so reverse for the most reproducible first
+        eigvals, eigvecs = eigh(S, Q)
+        self.eigvals = eigvals[::-1]
+        self.filters = eigvecs[:, ::-1][:, :self.n_components]
+        return self
+
+    def target_means(self):
+        '''
+        :returns dict: target -> (channels, samples) average of its centered trials
+        '''
+        return {target: self.trial_sums[target] / count for target, count in self.counts.items()}
+
+    def statistics(self):
+        '''
+        :returns dict: the sufficient statistics as arrays, see `save_statistics`
+        '''
+        targets = sorted(self.counts)
+        return {"targets": np.array(targets), "counts": np.array([self.counts[t] for t in targets]),
+                "trial_sums": np.stack([self.trial_sums[t] for t in targets]),
+                "covariances": np.stack([self.covariances[t] for t in targets]),
+                "lagged": self.lagged, "n_components": -1 if self.n_components is None else self.n_components}
+
+    def restore_statistics(self, statistics):
+        '''
+        Replace the statistics with ones returned by `statistics` and solve for the filters.
+
+        :param statistics: mapping with the keys `statistics` returns, e.g. a loaded .npz file
+        :returns TRCA: this instance
+        '''
+        targets = statistics["targets"].tolist()
+        self.counts = dict(zip(targets, statistics["counts"].tolist()))
+        self.trial_sums = dict(zip(targets, statistics["trial_sums"]))
+        self.covariances = dict(zip(targets, statistics["covariances"]))
+        self.lagged = statistics["lagged"]
+        return self._solve()
+
+    def save_statistics(self, path):
+        '''
+        Save the sufficient statistics to an .npz file, so later blocks can be added with `partial_fit`.
+        '''
+        np.savez(path, **self.statistics())
+
+    @classmethod
+    def load_statistics(cls, path):
+        '''
+        Load statistics saved with `save_statistics` and solve for the filters.
+        '''
+        with np.load(path) as stats:
+            n_components = int(stats["n_components"])
+            return cls(None if n_components < 0 else n_components).restore_statistics(stats)
+
+    def transform(self, eeg_data):
+        '''
+        Project EEG data onto the TRCA components.
+
+        :param eeg_data: array of shape (..., channels, samples)
+        :returns np.ndarray: array of shape (..., components, samples)
+        '''
+        if self.filters is None:
+            raise RuntimeError("TRCA has not been fitted yet")
+        return np.matmul(self.filters.T, eeg_data)
+
+    def fit_transform(self, eeg_data):
+        '''
+        Fit the filters and project the trial-averaged data onto them.
+
+        :param eeg_data: array of shape (channels, samples) or (trials, channels, samples)
+        :returns np.ndarray: array of shape (components, samples)
+        '''
+        eeg_data = np.asarray(eeg_data)
+        if eeg_data.ndim == 2:
+            eeg_data = eeg_data[np.newaxis, :, :]
+        self.fit(eeg_data)
+        return self.transform(eeg_data.mean(axis=0))  # Averaging across trials
+
+
+class EnsembleTRCA(TRCA):
+    '''
+    Ensemble TRCA: one set of spatial filters per target, fitted on that
+    target's trials only, and stacked so every window is projected onto the
+    filters of all targets.
+
+    The per-target S and Q matrices come from the same statistics as `TRCA`,
+    stacked into (targets, channels, channels) tensors and solved with
+    `batched_generalized_eigh`, so fitting 32 targets costs one batched solve
+    rather than 32 eigenproblems. Every target needs at least two trials.
+    '''
+    def __init__(self, n_components=1):
+        super().__init__(n_components)
+
+    def fit(self, eeg_data, targets):
+        return super().fit(eeg_data, targets)
+
+    def partial_fit(self, eeg_data, targets):
+        return super().partial_fit(eeg_data, targets)
+
+    def fit_transform(self, eeg_data, targets):
+        '''
+        Fit the filters and project every target's trial average onto the filters of all targets.
+
+        :param eeg_data: array of shape (trials, channels, samples)
+        :param targets: target of each trial
+        :returns np.ndarray: array of shape (targets, targets * components, samples), targets in sorted order
+        '''
+        self.fit(eeg_data, targets)
+        means = self.target_means()
+        return np.stack([self.transform(means[target]) for target in sorted(means)])
+
+    def _solve(self):
+        targets = sorted(self.counts)
+        if min(self.counts.values()) < 2:
+            raise ValueError("Ensemble TRCA needs at least two trials of every target")
+        trial_sums = np.stack([self.trial_sums[target] for target in targets])     # (targets, channels, samples)
+        Q = np.stack([self.covariances[target] for target in targets])             # (targets, channels, channels)
+        S = trial_sums @ trial_sums.transpose(0, 2, 1) - Q
+
+        eigvals, eigvecs = batched_generalized_eigh(S, Q)
+        self.eigvals = eigvals[:, :self.n_components]
+        # (channels, targets * components): the first components of target 0, then target 1, ...
+        self.filters = eigvecs[:, :, :self.n_components].transpose(1, 0, 2).reshape(eigvecs.shape[1], -1)
+        return self
@@ -33,6 +33,9 @@ import sys  # to get file system encoding
 import psychopy.iohub as io
 from psychopy.hardware import keyboard
 
+from codeSequences import resampleCodes
+from trainingStimuli import buildColorTable, loadWhiteNoise
+
 # --- Setup global variables (available in all functions) ---
 # create a device manager to handle hardware (keyboards, mice, mirophones, speakers, etc.)
 deviceManager = hardware.DeviceManager()
@@ -313,9 +316,6 @@ def pauseExperiment(thisExp, win=None, timers=[], playbackComponents=[]):
     for timer in timers:
         timer.addTime(-pauseTimer.getTime())
 
-def loadWhiteNoise(fileName):
-    return np.load(fileName, allow_pickle=True)
-
 def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
     """
     Run the experiment flow.
@@ -459,7 +459,8 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
     _timeToFirstFrame = win.getFutureFlipTime(clock="now")
     frameN = -1
     
-    noiseSequence = loadWhiteNoise("noiseSequences.npy")
+    # play the 60 Hz noise at the same speed whatever the monitor's refresh rate
+    colorTable = buildColorTable(resampleCodes(loadWhiteNoise("noiseSequences.npy"), int(round(1.0 / frameDur))))
     
     # --- Run Routine "trial" ---
     trial.forceEnded = routineForceEnded = not continueRoutine
@@ -500,6 +501,7 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
         offset = sqrt(2)/2
         
         # Update triangles
+        frameColors = colorTable[frameN % len(colorTable)]
         for i, triangle in enumerate(triangles):
             # If triangle is starting
             if triangle.status == NOT_STARTED and tThisFlip >= 0.0-frameTolerance:
@@ -507,10 +509,9 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
             
             # If triangle is active
             elif triangle.status == STARTED:
-                noiseFrame = frameN % 60
-                color = noiseSequence[i][noiseFrame][0] - 1
-                triangle.setFillColor([color, color, color], log=False)
-                triangle.setLineColor([color, color, color], log=False)
+                # assign the precomputed color directly rather than through setFillColor/setLineColor
+                triangle.fillColor = frameColors[i]
+                triangle.lineColor = frameColors[i]
                 triangle.setPos((mouse.getPos()[0], mouse.getPos()[1]), log=False)
             
         # *cursor* updates
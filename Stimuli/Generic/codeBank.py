@@ -0,0 +1,217 @@
+# Versioned, deterministic storage for the stimulus codes.
+# A code bank is a plain .npy array (float32 for white noise, uint8 for binary codes) plus a .json file
+# next to it recording how it was generated and the sha256 of its contents. Both are read without pickle,
+# so the stimuli and the decoder can check they use the identical codes.
+
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from codeSequences import CODE_FRAME_RATE, generateCodes, nearestBits
+
+CODE_BANK_VERSION = 1 # Bump whenever a generator in codeSequences.py changes its output for the same seed
+CODE_BANK_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'noiseSequences.npy')
+CODE_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'codeCache')
+
+
+def codeBankHash(codes):
+    """
+    sha256 of a code bank's contents, including its dtype and shape.
+
+    Parameters
+    ==========
+    codes : numpy.ndarray
+        Codes of shape (nTargets, frames, 1).
+
+    Returns
+    ==========
+    str
+        Hex digest.
+    """
+    codes = np.ascontiguousarray(codes)
+    digest = hashlib.sha256(f'{codes.dtype.str}{codes.shape}'.encode())
+    digest.update(codes.data)
+    return digest.hexdigest()
+
+
+def infoPath(path):
+    """
+    Path of the .json file describing the code bank at `path`.
+    """
+    return os.path.splitext(path)[0] + '.json'
+
+
+def generateCodeBank(kind='white', nTargets=8, nFrames=CODE_FRAME_RATE, nBits=6, seed=0, frameRate=CODE_FRAME_RATE):
+    """
+    Generate codes that are fully determined by their arguments and CODE_BANK_VERSION.
+
+    Parameters
+    ==========
+    kind : str
+        "white", "mseq" or "gold", see codeSequences.generateCodes.
+    nTargets : int
+        Number of codes.
+    nFrames : int
+        Length of white noise codes in frames.
+    nBits : int
+        Register length for "mseq" and "gold".
+    seed : int
+        Seed of the white noise generator.
+    frameRate : int
+        Refresh rate the codes are generated for.
+
+    Returns
+    ==========
+    tuple
+        Codes of shape (nTargets, frames, 1) (float32 white noise or uint8 binary codes)
+        and a dict describing them.
+    """
+    codes, lags = generateCodes(kind, nTargets, nFrames, nBits, np.random.default_rng(seed))
+    codes = np.ascontiguousarray(codes, dtype=np.float32 if kind == 'white' else np.uint8)
+    info = {
+        'version': CODE_BANK_VERSION,
+        'kind': kind,
+        'seed': seed,
+        'nBits': None if kind == 'white' else nBits,
+        'frameRate': frameRate,
+        'lags': None if lags is None else [int(lag) for lag in lags],
+    }
+    return codes, info
+
+
+def saveCodeBank(path, codes, info):
+    """
+    Save codes to `path` (.npy, no pickle) and their description with a content hash next to it.
+
+    Returns
+    ==========
+    dict
+        The description that was saved, including 'sha256', 'dtype' and 'shape'.
+    """
+    codes = np.ascontiguousarray(codes)
+    info = dict(info, sha256=codeBankHash(codes), dtype=codes.dtype.str, shape=list(codes.shape))
+    np.save(path, codes, allow_pickle=False)
+    with open(infoPath(path), 'w') as file:
+        json.dump(info, file, indent=2)
+    return info
+
+
+def readCodeBankInfo(path):
+    """
+    Read the description of a code bank without loading its codes.
+
+    Returns
+    ==========
+    dict or None
+        The saved description, or None for a bare .npy file without one.
+    """
+    if not os.path.exists(infoPath(path)):
+        return None
+    with open(infoPath(path), 'r') as file:
+        return json.load(file)
+
+
+def loadCodeBank(path=CODE_BANK_FILE, mmap=False, verify=True, expectedHash=None):
+    """
+    Load a code bank without pickle.
+
+    Parameters
+    ==========
+    path : str
+        Code bank .npy file.
+    mmap : bool
+        Memory-map the codes instead of reading them into memory.
+    verify : bool
+        Check the codes against the hash saved with them.
+    expectedHash : str or None
+        Also require this hash, e.g. the one a decoder was trained with.
+
+    Returns
+    ==========
+    tuple
+        The codes and their description.
+
+    Raises
+    ==========
+    ValueError
+        If the codes do not match the saved or expected hash.
+    """
+    codes = np.load(path, mmap_mode='r' if mmap else None, allow_pickle=False)
+    info = readCodeBankInfo(path)
+    if info is None:
+        info = {'version': None, 'sha256': codeBankHash(codes)}
+    elif verify and codeBankHash(codes) != info['sha256']:
+        raise ValueError(f'{path} does not match the hash saved with it, the codes have been modified')
+    if expectedHash is not None and info['sha256'] != expectedHash:
+        raise ValueError(f'{path} is not the expected code bank ({info["sha256"][:12]} != {expectedHash[:12]})')
+    return codes, info
+
+
+def codesForRate(frameRate, kind='white', nTargets=8, length=1, seed=0, cacheDir=CODE_CACHE_DIR):
+    """
+    Generate codes at a display's own refresh rate, so a 120 or 144 Hz monitor shows
+    a new code value every frame instead of repeating 60 Hz frames. The codes are
+    fully determined by (kind, seed, rate, length, nTargets) and CODE_BANK_VERSION, and
+    are cached on disk as a code bank under those keys, so every run at the same rate
+    shows the identical codes. A cached bank that does not match its hash is regenerated.
+
+    Parameters
+    ==========
+    frameRate : float
+        Measured refresh rate of the display; rounded to whole frames per second.
+    kind : str
+        "white", "mseq" or "gold", see codeSequences.generateCodes.
+    nTargets : int
+        Number of targets to generate codes for.
+    length : float
+        Length of the code in seconds. m-sequences and Gold codes use the register
+        length whose period is closest to it.
+    seed : int
+        Seed of the white noise generator.
+    cacheDir : str or None
+        Folder to cache the codes in, leave as None to always regenerate.
+
+    Returns
+    ==========
+    tuple
+        Codes of shape (nTargets, frames, 1) and the lag in frames of every target (None for white noise).
+    """
+    frameRate = int(round(frameRate))
+    nFrames = int(round(frameRate * length))
+    nBits = None if kind == 'white' else nearestBits(nFrames, kind)
+    path = None if cacheDir is None else os.path.join(
+        cacheDir, f'{kind}_seed{seed}_rate{frameRate}_len{nFrames}_n{nTargets}_v{CODE_BANK_VERSION}.npy')
+
+    info = None
+    if path is not None and os.path.exists(path) and os.path.exists(infoPath(path)):
+        try:
+            codes, info = loadCodeBank(path)
+        except ValueError:
+            info = None     # Modified since it was cached
+    if info is None:
+        codes, info = generateCodeBank(kind, nTargets, nFrames, nBits, seed, frameRate)
+        if path is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+            info = saveCodeBank(path, codes, info)
+    return codes, None if info['lags'] is None else np.array(info['lags'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--verify', help='Check a code bank against its saved hash and print its description')
+    parser.add_argument('--code', choices=['white', 'mseq', 'gold'], default='white', help='Kind of code to generate')
+    parser.add_argument('--targets', type=int, default=8, help='Number of codes to generate')
+    parser.add_argument('--frames', type=int, default=CODE_FRAME_RATE, help='Length of white noise codes in frames')
+    parser.add_argument('--bits', type=int, default=6, help='Register length for m-sequences and Gold codes')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the white noise generator')
+    parser.add_argument('--output', default=CODE_BANK_FILE, help='Code bank file to write')
+    args = parser.parse_args()
+
+    if args.verify:
+        print(json.dumps(loadCodeBank(args.verify)[1], indent=2))
+    else:
+        codes, info = generateCodeBank(args.code, args.targets, args.frames, args.bits, args.seed)
+        print(json.dumps(saveCodeBank(args.output, codes, info), indent=2))
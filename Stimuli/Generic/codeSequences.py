@@ -0,0 +1,184 @@
+# Code generators for the code-modulated (cVEP) stimuli.
+# Every generator returns values in [0, 1]; the stimuli subtract 1 before using a value as a color.
+
+import numpy as np
+
+CODE_FRAME_RATE = 60 # Refresh rate noiseSequences.npy is generated for
+
+# Feedback taps of maximal-length linear feedback shift registers, and the preferred
+# pairs that combine into Gold codes (no preferred pairs exist when nBits is a multiple of 4)
+MSEQUENCE_TAPS = {5: (5, 2), 6: (6, 1), 7: (7, 3), 8: (8, 6, 5, 4), 9: (9, 4), 10: (10, 3)}
+GOLD_PREFERRED_TAPS = {
+    5: ((5, 2), (5, 4, 3, 2)),
+    6: ((6, 1), (6, 5, 2, 1)),
+    7: ((7, 3), (7, 3, 2, 1)),
+    9: ((9, 4), (9, 6, 4, 3)),
+    10: ((10, 3), (10, 8, 3, 2)),
+}
+
+
+def whiteNoise(nFrames, rng=None):
+    """
+    Uniform white noise, one value per frame.
+
+    Parameters
+    ==========
+    nFrames : int
+        Length of the code in frames.
+    rng : numpy.random.Generator or None
+        Random generator to draw from, leave as None for a fresh unseeded one.
+
+    Returns
+    ==========
+    numpy.ndarray
+        Float array of shape (nFrames,).
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    return rng.random(nFrames)
+
+
+def mSequence(nBits=6, taps=None, seed=1):
+    """
+    Maximal-length sequence from a Fibonacci linear feedback shift register.
+
+    Parameters
+    ==========
+    nBits : int
+        Register length; the sequence is 2**nBits - 1 frames long (63 frames for 6 bits).
+    taps : tuple or None
+        Feedback taps (1-based), leave as None to use MSEQUENCE_TAPS.
+    seed : int
+        Non-zero initial register state.
+
+    Returns
+    ==========
+    numpy.ndarray
+        Array of 0s and 1s of shape (2**nBits - 1,).
+    """
+    if taps is None:
+        taps = MSEQUENCE_TAPS[nBits]
+    state = [(seed >> bit) & 1 for bit in range(nBits)]
+    if not any(state):
+        raise ValueError("The register seed must be non-zero")
+    sequence = np.empty(2 ** nBits - 1, dtype=np.uint8)
+    for i in range(len(sequence)):
+        sequence[i] = state[-1]
+        feedback = 0
+        for tap in taps:
+            feedback ^= state[tap - 1]
+        state = [feedback] + state[:-1]
+    return sequence
+
+
+def goldCode(nBits=6, shift=0):
+    """
+    Gold code: the XOR of a preferred pair of m-sequences, with the second one
+    circularly shifted. Different shifts give a family of 2**nBits - 1 codes
+    with bounded cross-correlation.
+
+    Parameters
+    ==========
+    nBits : int
+        Register length of the two m-sequences.
+    shift : int
+        Circular shift of the second m-sequence, selecting the member of the family.
+
+    Returns
+    ==========
+    numpy.ndarray
+        Array of 0s and 1s of shape (2**nBits - 1,).
+    """
+    tapsA, tapsB = GOLD_PREFERRED_TAPS[nBits]
+    return mSequence(nBits, tapsA) ^ np.roll(mSequence(nBits, tapsB), shift)
+
+
+def circularShiftCodes(code, nTargets):
+    """
+    Derive one code per target from a single code by evenly spaced circular lags,
+    as in classic cVEP spellers. Target i sees the code delayed by lag i.
+
+    Parameters
+    ==========
+    code : numpy.ndarray
+        Code of shape (frames,).
+    nTargets : int
+        Number of targets; at most one target per frame of lag.
+
+    Returns
+    ==========
+    tuple
+        Codes of shape (nTargets, frames) and the lag in frames of every target.
+    """
+    if nTargets > len(code):
+        raise ValueError(f"A {len(code)}-frame code cannot give {nTargets} distinct lags")
+    lags = np.arange(nTargets) * len(code) // nTargets
+    frames = (np.arange(len(code)) - lags[:, None]) % len(code)
+    return code[frames], lags
+
+
+def generateCodes(kind="white", nTargets=8, nFrames=60, nBits=6, rng=None):
+    """
+    Generate the codes for every target in the layout expected by the stimuli.
+
+    Parameters
+    ==========
+    kind : str
+        "white" for independent white noise per target, "mseq" for circular lags of one
+        m-sequence, or "gold" for circular lags of one Gold code.
+    nTargets : int
+        Number of targets to generate codes for.
+    nFrames : int
+        Length of white noise codes in frames (m-sequences and Gold codes are 2**nBits - 1).
+    nBits : int
+        Register length for "mseq" and "gold".
+    rng : numpy.random.Generator or None
+        Random generator for "white".
+
+    Returns
+    ==========
+    tuple
+        Codes of shape (nTargets, frames, 1) and the lag in frames of every target
+        (None for white noise, whose targets do not share a code).
+    """
+    if kind == "white":
+        return np.stack([whiteNoise(nFrames, rng) for _ in range(nTargets)])[:, :, None], None
+    if kind == "mseq":
+        codes, lags = circularShiftCodes(mSequence(nBits), nTargets)
+    elif kind == "gold":
+        codes, lags = circularShiftCodes(goldCode(nBits), nTargets)
+    else:
+        raise ValueError(f"Unknown code kind {kind!r}")
+    return codes[:, :, None].astype(np.float64), lags
+
+
+def resampleCodes(codes, toRate, fromRate=CODE_FRAME_RATE):
+    """
+    Resample codes to another refresh rate so they play at the same speed: each
+    frame is held for as long as it would have been on screen at fromRate.
+
+    Parameters
+    ==========
+    codes : numpy.ndarray
+        Codes of shape (nTargets, frames, 1), e.g. noiseSequences.npy.
+    toRate : int
+        Refresh rate of the display.
+    fromRate : int
+        Refresh rate the codes were generated for.
+
+    Returns
+    ==========
+    numpy.ndarray
+        Codes of shape (nTargets, round(frames * toRate / fromRate), 1).
+    """
+    codes = np.asarray(codes)
+    nFrames = int(round(codes.shape[1] * toRate / fromRate))
+    return codes[:, np.arange(nFrames) * fromRate // toRate]
+
+
+def nearestBits(nFrames, kind):
+    """
+    Register length whose code period (2**nBits - 1 frames) is closest to nFrames.
+    """
+    available = GOLD_PREFERRED_TAPS if kind == "gold" else MSEQUENCE_TAPS
+    return min(available, key=lambda nBits: abs(2 ** nBits - 1 - nFrames))
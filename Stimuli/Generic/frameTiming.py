@@ -0,0 +1,189 @@
+# Frame timing instrumentation for the stimulus scripts.
+# cVEP decoding assumes every frame of the code was actually shown, so the stimuli record the time of
+# every flip and report dropped frames and jitter next to the session data.
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from trainingStimuli import buildColorTable
+
+
+class FrameTimer:
+    """
+    Record the return time of every `win.flip()` into a preallocated array.
+
+    Parameters
+    ==========
+    frameRate : float
+        Refresh rate the stimuli are meant to run at.
+    capacity : int
+        Number of flips to preallocate room for; the buffer doubles if a session runs longer.
+    """
+    def __init__(self, frameRate=60.0, capacity=20000):
+        self.frameRate = frameRate
+        self.flipTimes = np.empty(capacity, dtype=np.float64)
+        self.nFlips = 0
+        self.trialStarts = []
+
+    def reset(self, frameRate=None):
+        """
+        Forget all recorded flips, optionally changing the expected refresh rate.
+        """
+        if frameRate is not None:
+            self.frameRate = frameRate
+        self.nFlips = 0
+        self.trialStarts = []
+
+    def record(self, flipTime):
+        """
+        Store the time returned by `win.flip()`.
+        """
+        if self.nFlips == len(self.flipTimes):
+            self.flipTimes = np.concatenate([self.flipTimes, np.empty_like(self.flipTimes)])
+        self.flipTimes[self.nFlips] = flipTime
+        self.nFlips += 1
+
+    def markTrial(self):
+        """
+        Mark the next flip as the first frame of a trial.
+        """
+        self.trialStarts.append(self.nFlips)
+
+    def report(self):
+        """
+        Summarize the recorded flips.
+
+        Returns
+        ==========
+        dict
+            Number of flips, dropped frames, interval jitter percentiles (ms) and the
+            number of dropped frames within each marked trial.
+        """
+        return frameReport(self.flipTimes[:self.nFlips], self.frameRate, self.trialStarts)
+
+    def save(self, fileName):
+        """
+        Save the flip times to `fileName + '.npy'` and the report to `fileName + '.json'`.
+        """
+        np.save(fileName + '.npy', self.flipTimes[:self.nFlips])
+        with open(fileName + '.json', 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+
+def frameReport(flipTimes, frameRate, trialStarts=()):
+    """
+    Dropped frames and jitter of a sequence of flip times.
+
+    Parameters
+    ==========
+    flipTimes : numpy.ndarray
+        Time of every flip in seconds.
+    frameRate : float
+        Refresh rate the stimuli are meant to run at.
+    trialStarts : list
+        Index of the first flip of every trial.
+
+    Returns
+    ==========
+    dict
+        Summary that can be saved as JSON.
+    """
+    frameDur = 1.0 / frameRate
+    intervals = np.diff(flipTimes)
+    # An interval of ~2 frame durations means one frame was shown twice, i.e. one code frame was lost
+    dropped = np.maximum(np.round(intervals / frameDur) - 1, 0).astype(int)
+    jitterMs = np.abs(intervals - frameDur) * 1000
+
+    # Dropped frames between the start of each trial and the start of the next
+    bounds = list(trialStarts) + [len(flipTimes)]
+    trialDropped = [int(dropped[max(start - 1, 0):max(end - 1, 0)].sum()) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    report = {
+        'frameRate': float(frameRate),
+        'nFlips': int(len(flipTimes)),
+        'droppedFrames': int(dropped.sum()),
+        'meanIntervalMs': float(intervals.mean() * 1000) if len(intervals) else None,
+        'trialDroppedFrames': trialDropped,
+    }
+    for q in (50, 95, 99, 100):
+        report[f'jitterP{q}Ms'] = float(np.percentile(jitterMs, q)) if len(jitterMs) else None
+    return report
+
+
+def benchmarkRenderLoop(nFrames=3000, nTriangles=8, nTargets=32, noiseFile=None):
+    """
+    Measure the per-frame CPU cost of the stimulus update loop without a display.
+
+    A hidden PsychoPy window is used when one can be opened, so the ElementArrayStim
+    color update and draw are included; otherwise (e.g. on a headless machine) only
+    the Python-side work of the loop is timed.
+
+    Returns
+    ==========
+    dict
+        Per-frame CPU time percentiles in milliseconds and whether a window was used.
+    """
+    if noiseFile is None:
+        noiseFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'noiseSequences.npy')
+    colorTable = buildColorTable(np.load(noiseFile), nTriangles)
+    targetOpacities = np.zeros(nTargets)
+
+    win = None
+    try:
+        from psychopy import visual
+        win = visual.Window(size=(800, 800), visible=False, units='height', checkTiming=False)
+        triangles = visual.ElementArrayStim(win=win, nElements=nTriangles, sizes=(0.5, 1), elementTex=None,
+                                            elementMask='circle', colors=colorTable[0], autoLog=False)
+        targets = visual.ElementArrayStim(win=win, nElements=nTargets, sizes=0.1, elementTex=None,
+                                          elementMask='circle', opacities=targetOpacities, autoLog=False)
+    except Exception:
+        win = None
+
+    frameCosts = np.empty(nFrames, dtype=np.float64)
+    for frameN in range(nFrames):
+        start = time.perf_counter()
+        frameColors = colorTable[frameN % len(colorTable)]
+        if frameN % 60 == 0:
+            targetOpacities[:] = 0
+            targetOpacities[(frameN // 60) % nTargets] = 0.25
+        if win is not None:
+            triangles.colors = frameColors
+            if frameN % 60 == 0:
+                targets.opacities = targetOpacities
+            triangles.draw()
+            targets.draw()
+        frameCosts[frameN] = time.perf_counter() - start
+        if win is not None:
+            win.flip(clearBuffer=True)
+
+    if win is not None:
+        win.close()
+    costsMs = frameCosts * 1000
+    return {
+        'usedWindow': win is not None,
+        'nFrames': nFrames,
+        'cpuMsP50': float(np.percentile(costsMs, 50)),
+        'cpuMsP95': float(np.percentile(costsMs, 95)),
+        'cpuMsP99': float(np.percentile(costsMs, 99)),
+        'cpuMsMax': float(costsMs.max()),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--benchmark', action='store_true', help='Time the render loop without a display')
+    group.add_argument('--report', help='Print the report of a saved flip time file (.npy)')
+    parser.add_argument('--frames', type=int, default=3000, help='Frames to run the benchmark for')
+    parser.add_argument('--targets', type=int, default=32, help='Number of targets in the benchmark')
+    parser.add_argument('--frame-rate', type=float, default=60, help='Expected refresh rate for --report')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(json.dumps(benchmarkRenderLoop(args.frames, nTargets=args.targets), indent=2))
+    else:
+        print(json.dumps(frameReport(np.load(args.report), args.frame_rate), indent=2))
@@ -1,17 +1,26 @@
 # This file generates the sequences of modulated white noise that will be loaded in the actual experiments
 # Do NOT re-generate the noise unless absolutely necessary since all of the trials need to use the SAME sequence of noise for the cVEPs to work!!!
+# The codes are generated from a recorded seed, so the same seed and code bank version always give the same codes
+# Besides white noise, the codes can be circular lags of one m-sequence or Gold code (--code mseq / --code gold),
+# which lets any number of targets share a single template in the decoder
 
-import numpy as np
+import argparse
 
-frameRate = 60 # Framerate of experiment
+from codeBank import generateCodeBank, saveCodeBank
+from codeSequences import CODE_FRAME_RATE
+
+frameRate = CODE_FRAME_RATE # Framerate the noise is generated for; the stimuli resample it to the monitor's rate
 length = 1 # Length of noise (seconds)
 numSegments = 8 # Number of sequences to generate
 
-def generateWhiteNoise():
-    return np.random.rand(frameRate * length, 1)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--code", choices=["white", "mseq", "gold"], default="white", help="Kind of code to generate")
+    parser.add_argument("--targets", type=int, default=numSegments, help="Number of codes to generate")
+    parser.add_argument("--bits", type=int, default=6, help="Register length for m-sequences and Gold codes")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the white noise generator, recorded with the codes")
+    args = parser.parse_args()
 
-def generateAllNoise():
-    return [generateWhiteNoise() for _ in range(numSegments)]
-    
-noise = generateAllNoise()
-np.save("noiseSequences.npy", noise)
\ No newline at end of file
+    # Saved as a code bank: a plain array plus noiseSequences.json with the seed, version, target lags and hash
+    codes, info = generateCodeBank(args.code, args.targets, frameRate * length, args.bits, args.seed, frameRate)
+    saveCodeBank("noiseSequences.npy", codes, info)
@@ -0,0 +1,166 @@
+# Layout of the training stimuli, shared by stage1train.py, stage2train.py and the decoder.
+# Eight noise-modulated triangles fan out from the centre of the screen and the targets sit on top of them.
+# Only NumPy is needed, so the decoder can work out which triangle (and therefore which code) drives each
+# target without importing PsychoPy. The helpers that load the codes and build the colors and masks of
+# the stimulus scripts live here too.
+
+import numpy as np
+
+from codeBank import codeBankHash, codesForRate, loadCodeBank
+from codeSequences import resampleCodes
+
+TRIANGLE_ORIS = np.arange(8) * 45       # Clockwise orientation of each triangle in degrees
+TRIANGLE_WIDTH = 2 * np.sin(45)
+TRIANGLE_HEIGHT = 2
+TARGET_RADIUS = 1/3
+
+
+def triangleCentres(oris=TRIANGLE_ORIS, height=TRIANGLE_HEIGHT):
+    """
+    Element centres of the triangles. Each triangle hangs from the centre of the
+    screen (anchor='top'), so its element centre is half a triangle height
+    below the origin, rotated clockwise by its orientation.
+
+    Returns
+    ==========
+    numpy.ndarray
+        Centres of shape (triangles, 2).
+    """
+    oris = np.deg2rad(oris)
+    return height / 2 * np.stack([-np.sin(oris), -np.cos(oris)], axis=1)
+
+
+def stage1TargetPositions(radius=TARGET_RADIUS):
+    """
+    Positions of the 8 Stage 1 targets, every 45 degrees counterclockwise from the right.
+
+    Returns
+    ==========
+    numpy.ndarray
+        Positions of shape (8, 2).
+    """
+    angles = np.deg2rad(np.arange(8) * 45)
+    return radius * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+
+
+def stage2TargetPositions(radius=TARGET_RADIUS):
+    """
+    Positions of the 32 Stage 2 targets: for each i, the target at 45*i degrees
+    and the one halfway to the centre, then the target at 22.5*i degrees and the
+    one halfway to the centre.
+
+    Returns
+    ==========
+    numpy.ndarray
+        Positions of shape (32, 2).
+    """
+    positions = []
+    for i in range(8):
+        for angle in (np.deg2rad(i * 45), np.deg2rad(i * 22.5)):
+            x, y = radius * np.cos(angle), radius * np.sin(angle)
+            positions.extend([[x, y], [x / 2, y / 2]])
+    return np.array(positions)
+
+
+def targetTriangles(targetPositions, oris=TRIANGLE_ORIS, width=TRIANGLE_WIDTH, height=TRIANGLE_HEIGHT):
+    """
+    Triangle each target is drawn on. A target inside two overlapping triangles
+    is on the one drawn last, which ElementArrayStim draws on top.
+
+    Parameters
+    ==========
+    targetPositions : numpy.ndarray
+        Target positions of shape (targets, 2).
+
+    Returns
+    ==========
+    numpy.ndarray
+        Index of the triangle under every target.
+    """
+    positions = np.asarray(targetPositions, dtype=np.float64)
+    centres = triangleCentres(oris, height)
+    radians = np.deg2rad(oris)
+    # Undo each triangle's clockwise rotation to get the targets in the triangle's own frame
+    offsets = positions[:, np.newaxis, :] - centres[np.newaxis, :, :]
+    x = offsets[..., 0] * np.cos(radians) - offsets[..., 1] * np.sin(radians)
+    y = (offsets[..., 0] * np.sin(radians) + offsets[..., 1] * np.cos(radians)) / (height / 2)
+    # Apex at the top centre, base along the bottom edge, as in buildTriangleMask
+    inside = (np.abs(y) <= 1) & (np.abs(x) / (width / 2) <= (1 - y) / 2 + 1e-9)
+    if not inside.any(axis=1).all():
+        raise ValueError(f"Targets {np.flatnonzero(~inside.any(axis=1)).tolist()} are not on any triangle")
+    return len(oris) - 1 - np.argmax(inside[:, ::-1], axis=1)
+
+
+def loadWhiteNoise(fileName):
+    return loadCodeBank(fileName)[0]
+
+
+def loadCodes(fileName, frameRate, codeSeed=''):
+    """
+    Load the codes to show at the monitor's refresh rate.
+
+    Parameters
+    ==========
+    fileName : str
+        Noise sequences saved by generateWhiteNoise.py (generated for 60 Hz).
+    frameRate : int
+        Measured refresh rate of the monitor.
+    codeSeed : str
+        Leave blank to resample the saved sequences so they play at the same speed on any
+        monitor, or give a seed to regenerate white noise with a new value every frame.
+
+    Returns
+    ==========
+    tuple
+        Codes of shape (triangles, frames, 1) and the hash of the code bank they come from.
+    """
+    if str(codeSeed).strip() == '':
+        codes, info = loadCodeBank(fileName)
+        return resampleCodes(codes, frameRate), info['sha256']
+    codes = codesForRate(frameRate, seed=int(codeSeed))[0]
+    return codes, codeBankHash(codes)
+
+
+def buildColorTable(noiseSequence, nElements=None):
+    """
+    Precompute the color of every element on every frame of the noise sequence.
+
+    Parameters
+    ==========
+    noiseSequence : numpy.ndarray
+        Noise values in [0, 1] of shape (codes, frames, 1), as saved by generateWhiteNoise.py.
+    nElements : int
+        Number of elements drawn, one code each. A bank with more codes (e.g. lagged codes
+        generated for 32 targets) only contributes its first nElements codes.
+
+    Returns
+    ==========
+    numpy.ndarray
+        Contiguous float32 RGB colors of shape (frames, elements, 3).
+    """
+    if nElements is not None:
+        if len(noiseSequence) < nElements:
+            raise ValueError(f"The code bank has {len(noiseSequence)} codes but {nElements} elements are drawn")
+        noiseSequence = noiseSequence[:nElements]
+    noise = np.asarray(noiseSequence, dtype=np.float32).reshape(len(noiseSequence), -1)
+    return np.ascontiguousarray(np.repeat((noise.T - 1)[:, :, np.newaxis], 3, axis=2))
+
+
+def buildTriangleMask(texRes=128):
+    """
+    Build an element mask for ElementArrayStim that matches ShapeStim's 'triangle'
+    vertices: apex at the top centre, base along the bottom edge.
+
+    Parameters
+    ==========
+    texRes : int
+        Resolution of the (square, power of 2) mask.
+
+    Returns
+    ==========
+    numpy.ndarray
+        Mask of shape (texRes, texRes), 1 inside the triangle and -1 outside.
+    """
+    # texture rows run from the bottom (y = -1) to the top (y = +1) of the element
+    x, y = np.meshgrid(np.linspace(-1, 1, texRes), np.linspace(-1, 1, texRes))
+    return np.where(np.abs(x) <= (1 - y) / 2, 1.0, -1.0)
@@ -33,6 +33,18 @@ import sys  # to get file system encoding
 import psychopy.iohub as io
 from psychopy.hardware import keyboard
 
+# trial onset markers are sent to collect_training_data.py over a loopback socket
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "Training"))
+from markers import MarkerSender
+# when started by run_session.py, the start and the trial log go through its control channel instead
+from session_control import SessionControlClient
+# flip times are recorded to report dropped frames next to the session data
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Generic"))
+from frameTiming import FrameTimer
+# the decoder reads the same layout to know which triangle's code drives each target
+from trainingStimuli import (TRIANGLE_HEIGHT, TRIANGLE_ORIS, TRIANGLE_WIDTH, stage1TargetPositions,
+                             triangleCentres, loadCodes, buildColorTable, buildTriangleMask)
+
 # --- Setup global variables (available in all functions) ---
 # create a device manager to handle hardware (keyboards, mice, mirophones, speakers, etc.)
 deviceManager = hardware.DeviceManager()
@@ -45,6 +57,7 @@ expName = 'stage1train'  # from the Builder filename that created this script
 expInfo = {
     'participant': f"{randint(0, 999999):06.0f}",
     'session': '001',
+    'codeSeed': '',  # blank shows noiseSequences.npy, a number regenerates the codes at the monitor's rate
     'date|hid': data.getDateStr(),
     'expName|hid': expName,
     'psychopyVersion|hid': psychopyVersion,
@@ -313,10 +326,10 @@ def pauseExperiment(thisExp, win=None, timers=[], playbackComponents=[]):
     for timer in timers:
         timer.addTime(-pauseTimer.getTime())
 
-def loadWhiteNoise(fileName):
-    return np.load(fileName, allow_pickle=True)
-
 selectedTargets = []
+displayedCodeBank = None  # hash of the codes shown, saved with the targets for the session header
+frameTimer = FrameTimer()
+sessionControl = SessionControlClient.from_environment('stimulus')  # None when run from PsychoPy Coder
 
 def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
     """
@@ -377,21 +390,22 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
         colorSpace='rgb', lineColor=[1.0, -1.0, -1.0], fillColor=[1.0000, -1.0000, -1.0000],
         opacity=None, depth=-10.0, interpolate=True)
         
-    triangles = []
-    targets = []
+    targetPositions = stage1TargetPositions()
     targetTimesRemaining = [6, 6, 6, 6, 6, 6, 6, 6]
-    width = 2 * sin(45)
-    for i in range(8):
-        triangles.append(visual.ShapeStim(win=win, name='triangle'+str(i), size=(width, 2), vertices='triangle', ori=i*45, pos=[0,0], draggable=True, anchor='top',
-        lineWidth=1.0, colorSpace='rgb', lineColor='white', fillColor='white', opacity=None, depth=-2.0, interpolate=True))
-        
-        # Calculate position of target
-        angle = deg2rad(i * 45)
-        x = 1/3 * cos(angle)
-        y = 1/3 * sin(angle)
-        
-        targets.append(visual.ShapeStim(win=win, name='cursor', size=(0.1, 0.1), vertices='circle', ori=0, pos=[x,y], draggable=False, anchor='center',
-        lineWidth=1.0, colorSpace='rgb', lineColor=[-1.0, 1.0, -1.0], fillColor=[-1.0, 1.0, -1.0], opacity=0, depth=-10.0, interpolate=True))
+    
+    # All triangles and all targets are drawn as two element arrays (one draw call each)
+    # Each triangle hangs from the centre (anchor='top'), see trainingStimuli.triangleCentres
+    triangles = visual.ElementArrayStim(win=win, name='triangles', nElements=len(TRIANGLE_ORIS), xys=triangleCentres(),
+        sizes=(TRIANGLE_WIDTH, TRIANGLE_HEIGHT), oris=TRIANGLE_ORIS, colors=[1.0, 1.0, 1.0], colorSpace='rgb', opacities=1.0,
+        elementTex=None, elementMask=buildTriangleMask(), texRes=128, interpolate=True, autoLog=False)
+    triangles.depth = -2.0
+    
+    targetOpacities = np.zeros(len(targetPositions))
+    shownTarget = -1  # target whose opacity is currently raised
+    targets = visual.ElementArrayStim(win=win, name='targets', nElements=len(targetPositions), xys=targetPositions,
+        sizes=0.1, colors=[-1.0, 1.0, -1.0], colorSpace='rgb', opacities=targetOpacities,
+        elementTex=None, elementMask='circle', interpolate=True, autoLog=False)
+    targets.depth = -10.0
     
     startExperiment = False
     
@@ -401,7 +415,7 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
         stim.frameNStart = frameN  # exact frame index
         stim.tStart = t  # local t and not account for scr refresh
         stim.tStartRefresh = tThisFlipGlobal  # on global time
-        win.timeOnFlip(triangle, 'tStartRefresh')  # time at next scr refresh
+        win.timeOnFlip(stim, 'tStartRefresh')  # time at next scr refresh
         # add timestamp to datafile
         thisExp.timestampOnFlip(win, name + '.started')
         # update status
@@ -475,7 +489,16 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
     
     script_dir = os.path.dirname(os.path.abspath(__file__))
     noise_sequence_file = os.path.join(script_dir, "../Generic", "noiseSequences.npy")
-    noiseSequence = loadWhiteNoise(noise_sequence_file)
+    frameRate = int(round(1.0 / frameDur))
+    framesPerTrial = frameRate  # 1 second trials at any refresh rate
+    global displayedCodeBank
+    codes, displayedCodeBank = loadCodes(noise_sequence_file, frameRate, expInfo.get('codeSeed', ''))
+    thisExp.addData('codeBank', displayedCodeBank)  # lets the decoder check it was trained on the same codes
+    colorTable = buildColorTable(codes, len(TRIANGLE_ORIS))  # one code per triangle
+    markerSender = MarkerSender()
+    frameTimer.reset(frameRate=frameRate)
+    if sessionControl is not None:
+        sessionControl.ready()  # the orchestrator starts us and the recording together
     
     # --- Run Routine "trial" ---
     trial.forceEnded = routineForceEnded = not continueRoutine
@@ -516,20 +539,16 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
         offset = sqrt(2)/2
         
         # Update triangles
-        for i, triangle in enumerate(triangles):
-            # If triangle is starting
-            if triangle.status == NOT_STARTED and tThisFlip >= 0.0-frameTolerance:
-                initializeStim(triangle, "triangle"+str(i))
-            
-            # If triangle is active
-            elif triangle.status == STARTED:
-                noiseFrame = frameN % 60
-                color = noiseSequence[i][noiseFrame][0] - 1
-                triangle.setFillColor([color, color, color], log=False)
-                triangle.setLineColor([color, color, color], log=False)
-                #triangle.setPos((mouse.getPos()[0], mouse.getPos()[1]), log=False) Disabled in training
+        # If triangles are starting
+        if triangles.status == NOT_STARTED and tThisFlip >= 0.0-frameTolerance:
+            initializeStim(triangles, "triangles")
+        
+        # If triangles are active, set every triangle's color for this frame in one call
+        elif triangles.status == STARTED:
+            triangles.colors = colorTable[frameN % len(colorTable)]
         
-        if not startExperiment and defaultKeyboard.getKeys(keyList=["return"]):
+        if not startExperiment and (sessionControl.started() if sessionControl is not None
+                                    else defaultKeyboard.getKeys(keyList=["return"])):
             print("start experiment")
             startExperiment = True
             frameN = 0
@@ -537,9 +556,9 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
         # Target selection logic
         if not startExperiment:
             selectedTarget = -1
-        if startExperiment and frameN % 60 == 0: # every second after started
+        if startExperiment and frameN % framesPerTrial == 0: # every second after started
             targetsToPick = []
-            for i in range(8):
+            for i in range(len(targetPositions)):
                 if targetTimesRemaining[i] > 0:
                     targetsToPick.append(i)
             if len(targetsToPick) == 0: # If there are no more targets the experiment is over
@@ -547,20 +566,23 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
             else:
                 selectedTarget = targetsToPick[randint(0, high=len(targetsToPick))]
                 selectedTargets.append(selectedTarget)
+                # timestamp the onset on the flip that first shows this target
+                win.callOnFlip(markerSender.send, len(selectedTargets) - 1, selectedTarget)
+                frameTimer.markTrial()
                 targetTimesRemaining[selectedTarget] -= 1
         
         # Update targets
-        for i, target in enumerate(targets):
-            # If target is starting
-            if target.status == NOT_STARTED and tThisFlip >= 0.0-frameTolerance:
-                initializeStim(target, "target"+str(i))
-            
-            # If target is active
-            elif target.status == STARTED:
-                if i == selectedTarget:
-                    target.setOpacity(0.25)
-                else:
-                    target.setOpacity(0)
+        # If targets are starting
+        if targets.status == NOT_STARTED and tThisFlip >= 0.0-frameTolerance:
+            initializeStim(targets, "targets")
+        
+        # If targets are active, only touch the opacities when the selected target changes
+        elif targets.status == STARTED and selectedTarget != shownTarget:
+            targetOpacities[:] = 0
+            if selectedTarget >= 0:
+                targetOpacities[selectedTarget] = 0.25
+            targets.opacities = targetOpacities
+            shownTarget = selectedTarget
             
         # *cursor* updates
 
@@ -604,7 +626,7 @@ def run(expInfo, thisExp, win, globalClock=None, thisSession=None):
         
         # refresh the screen
         if continueRoutine:  # don't flip if this routine is over or we'll get a blank screen
-            win.flip()
+            frameTimer.record(win.flip())
     
     # --- Ending Routine "trial" ---
     for thisComponent in trial.components:
@@ -648,7 +670,12 @@ def saveData(thisExp):
     stimuli_indices_log = os.path.join(script_dir, "../../Training", "stimuli_indices.log")
     with open(stimuli_indices_log, 'w', newline='') as file:
         file.write(','.join(map(str, selectedTargets)))
+        file.write('\n' + str(displayedCodeBank))  # second line: the code bank hash
         file.close()
+    frameTimer.save(os.path.join(script_dir, "../../Training", "frame_timing"))
+    if sessionControl is not None:
+        sessionControl.send_trials(selectedTargets, displayedCodeBank)  # sent last, so the frame timing is already saved
+        sessionControl.close()
 
 
 def endExperiment(thisExp, win=None):
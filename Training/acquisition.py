@@ -0,0 +1,129 @@
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+
+class StreamingRecorder:
+    '''
+    Record a running BrainFlow stream to disk in small chunks.
+
+    A polling thread drains the board's ring buffer every `poll_interval`
+    seconds with `get_board_data` and hands each chunk to a writer thread
+    through a bounded queue. The writer appends the chunk to a SessionWriter,
+    so memory use stays flat for any session length and the BrainFlow buffer
+    never needs to hold more than a few chunks.
+
+    Given a `RingBuffer`, every polled chunk's EEG rows are also copied into
+    it, so consumers can read overlapping windows of the stream as views
+    while it records. With a `shared_stream.SharedRingBuffer` those consumers
+    can be other processes.
+    '''
+    def __init__(self, board, writer, eeg_channels, timestamp_channel, marker_channel=None, max_samples=None,
+                 poll_interval=0.1, queue_size=32, ring_buffer=None, ring_rows=None, allocation_meter=None):
+        '''
+        :param board: a BoardShim that is already streaming
+        :param writer: a raw_data.SessionWriter to append chunks to
+        :param eeg_channels: rows of the board data holding EEG samples
+        :param timestamp_channel: row of the board data holding timestamps
+        :param marker_channel: row of the board data holding inserted markers, if recorded
+        :param max_samples: stop after this many samples, or record until `stop` if None
+        :param poll_interval: seconds between polls of the board buffer
+        :param queue_size: maximum number of chunks waiting to be written
+        :param ring_buffer: a ring_buffer.RingBuffer to also copy the EEG samples into
+        :param ring_rows: rows of the board data copied into the ring buffer, the EEG channels by default
+        :param allocation_meter: a ring_buffer.AllocationMeter to measure every poll with
+        '''
+        self.board = board
+        self.writer = writer
+        self.eeg_channels = eeg_channels
+        self.timestamp_channel = timestamp_channel
+        self.marker_channel = marker_channel
+        self.max_samples = max_samples
+        self.poll_interval = poll_interval
+        self.ring_buffer = ring_buffer
+        self.ring_rows = eeg_channels if ring_rows is None else ring_rows
+        self.allocation_meter = allocation_meter
+        self.samples_recorded = 0
+        self.error = None
+
+        self._chunks = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._poll_thread = threading.Thread(target=self._poll, name="board-poll", daemon=True)
+        self._write_thread = threading.Thread(target=self._write, name="session-write", daemon=True)
+
+    def start(self):
+        '''
+        Discard whatever is already in the board buffer and begin recording.
+        '''
+        self.board.get_board_data()
+        self._write_thread.start()
+        self._poll_thread.start()
+
+    def stop(self):
+        '''
+        Stop polling, write every queued chunk and wait for both threads.
+        '''
+        self._stop_event.set()
+        self.join()
+
+    def join(self, timeout=None):
+        '''
+        Wait until recording has finished (`max_samples` reached or `stop` called).
+
+        :returns bool: True if both threads have exited
+        '''
+        self._poll_thread.join(timeout)
+        if self._poll_thread.is_alive():
+            return False
+        self._write_thread.join()
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def _poll(self):
+        try:
+            while not self._stop_event.is_set():
+                next_poll = time.monotonic() + self.poll_interval
+                if self._poll_once():
+                    break
+                self._stop_event.wait(max(0.0, next_poll - time.monotonic()))
+            else:
+                self._poll_once()   # Drain what arrived since the last poll
+        except Exception as e:
+            self.error = e
+        finally:
+            self._chunks.put(None)  # Tell the writer nothing else is coming
+
+    def _poll_once(self):
+        '''
+        Move the samples currently in the board buffer onto the write queue.
+
+        :returns bool: True once max_samples have been collected
+        '''
+        with self.allocation_meter if self.allocation_meter is not None else nullcontext():
+            count = self.board.get_board_data_count()
+            if self.max_samples is not None:
+                count = min(count, self.max_samples - self.samples_recorded)
+            if count > 0:
+                data = self.board.get_board_data(count)
+                markers = None if self.marker_channel is None else data[self.marker_channel]
+                if self.ring_buffer is not None:
+                    self.ring_buffer.write(data, rows=self.ring_rows)
+                self._chunks.put((data[self.eeg_channels], data[self.timestamp_channel], markers))  # Blocks if the writer falls behind
+                self.samples_recorded += data.shape[1]
+        return self.max_samples is not None and self.samples_recorded >= self.max_samples
+
+    def _write(self):
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                return
+            if self.error is not None:
+                continue            # Keep draining so the poll thread never blocks on a full queue
+            try:
+                self.writer.append(*chunk)
+            except Exception as e:
+                self.error = e
+                self._stop_event.set()
+
@@ -1,17 +1,30 @@
 import argparse
 import time
 import csv
+import json
 import os
+import sys
 
 import serial.tools.list_ports
-from brainflow.board_shim import BoardShim, BrainFlowInputParams, BoardIds, BrainFlowPresets
+from brainflow.board_shim import BoardShim, BrainFlowInputParams, BoardIds
 from pynput import keyboard
 
+from acquisition import StreamingRecorder
+from markers import MarkerReceiver
+from raw_data import SESSION_EXTENSION, SessionWriter
+from ring_buffer import AllocationMeter
+from session_control import SessionControlClient
+from shared_stream import STREAM_NAME, SharedRingBuffer
+
+RING_BUFFER_SECONDS = 4     # Newest samples kept in shared memory for live consumers
+TRIALS_TIMEOUT = 30         # Seconds to wait for the trial log from run_session.py after recording
+
 
 def file_args():
     '''
     Parse through the arguments for running this file.
     Expected, mutually-exclusive arguments: --train1, --train2
+    Optional arguments: --synthetic, --stream-name, --blocks, --measure-allocations
 
     :returns Namespace: the detected argument
     '''
@@ -20,6 +33,13 @@ def file_args():
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--train1", action="store_true", help="Choose training stage 1")
     group.add_argument("--train2", action="store_true", help="Choose training stage 2")
+
+    parser.add_argument("--synthetic", action="store_true", help="Record from BrainFlow's synthetic board instead of the Cyton")
+    parser.add_argument("--blocks", type=int, default=1,
+                        help="Record this many blocks in one board session, each to its own file")
+    parser.add_argument("--stream-name", default=STREAM_NAME, help="Shared memory segment the live samples are published in")
+    parser.add_argument("--measure-allocations", action="store_true",
+                        help="Measure the memory every board poll allocates with tracemalloc (slows the process down)")
     
     return parser.parse_args()
 
@@ -53,6 +73,92 @@ def wait_for_enter():
         listener.join()
 
 
+def read_stimuli_indices(stimuli_indices_log):
+    '''
+    Read the targets logged by the stimuli file into an ordered list. The first
+    line of the log holds the targets and the second the hash of the code bank shown.
+
+    :param stimuli_indices_log: path of the log written by the stimuli file
+    :returns tuple: the logged target indices, empty if there is no log, and the code bank hash or None
+    '''
+    if not os.path.exists(stimuli_indices_log):
+        print("No stimuli indices were logged, saving the session without them")
+        return [], None
+    with open(stimuli_indices_log, 'r') as file:
+        rows = list(csv.reader(file))
+    stimuli_indices = rows[0] if rows else []
+    code_bank = rows[1][0] if len(rows) > 1 and rows[1] and rows[1][0] != "None" else None
+    return stimuli_indices, code_bank
+
+
+def store_frame_timing(frame_timing_stem, raw_data_path):
+    '''
+    Move the flip times and dropped-frame report written by the stimuli file next
+    to the session file, as <session>.frames.npy and <session>.frames.json, and
+    warn about trials that lost frames.
+
+    :param frame_timing_stem: path of the stimuli file's frame timing files, without extension
+    :param raw_data_path: path of the session file
+    '''
+    report_path = frame_timing_stem + ".json"
+    if not os.path.exists(report_path):
+        print("No frame timing was logged, saving the session without it")
+        return
+    with open(report_path, 'r') as file:
+        report = json.load(file)
+    for extension in (".npy", ".json"):
+        os.replace(frame_timing_stem + extension, raw_data_path + ".frames" + extension)
+
+    dropped_trials = [i for i, dropped in enumerate(report["trialDroppedFrames"]) if dropped > 0]
+    print(f"{report['droppedFrames']} dropped frames, p99 flip jitter {report['jitterP99Ms']} ms")
+    if dropped_trials:
+        print(f"Trials with dropped frames: {dropped_trials}")
+
+
+def block_paths(directory, session_date_time, blocks):
+    '''
+    :param directory: directory of the stage's sessions
+    :param session_date_time: timestamp naming the session
+    :param blocks: number of blocks recorded in this board session
+    :returns list: the session file of every block, numbered when there is more than one
+    '''
+    if blocks == 1:
+        return [os.path.join(directory, f"{session_date_time}{SESSION_EXTENSION}")]
+    return [os.path.join(directory, f"{session_date_time}_block{block + 1:02d}{SESSION_EXTENSION}")
+            for block in range(blocks)]
+
+
+def finish_block(writer, raw_data_path, events, control, stimuli_indices_log, frame_timing_stem):
+    '''
+    Finalize one block's session file once the stimuli have reported the targets they showed.
+
+    :param writer: the block's SessionWriter
+    :param raw_data_path: path of the block's session file
+    :param events: the (trial, target, flip_time) markers received during the block
+    :param control: the SessionControlClient when started by run_session.py, otherwise None
+    :param stimuli_indices_log: path of the log written by the stimuli file
+    :param frame_timing_stem: path of the stimuli file's frame timing files, without extension
+    '''
+    if control is not None:
+        # The stimuli send the targets they showed once their logs are saved
+        trials = control.wait_for_trials(TRIALS_TIMEOUT)
+        if trials is None:
+            print("No stimuli indices were received, saving the session without them")
+            trials = ([], None)
+        stimuli_indices, code_bank = trials
+    else:
+        time.sleep(1)   # Wait to ensure target display order has been logged
+        stimuli_indices, code_bank = read_stimuli_indices(stimuli_indices_log)
+        if os.path.exists(stimuli_indices_log):
+            os.remove(stimuli_indices_log)  # So the next block can never pick up this block's targets
+
+    # Finalize the Binary Session File with the Ordered Targets (see raw_data.py for the layout)
+    writer.close(stimuli_indices, events, code_bank)
+    store_frame_timing(frame_timing_stem, raw_data_path)
+    if control is not None:
+        control.done(session=raw_data_path)
+
+
 def main():
     # Setup Arguments that Specify which Training Stimuli is Being Used
     args = file_args()
@@ -60,8 +166,9 @@ def main():
     # Directory/File Initializations
     script_dir = os.path.dirname(os.path.abspath(__file__))
     stimuli_indices_log = os.path.join(script_dir, "stimuli_indices.log")
+    frame_timing_stem = os.path.join(script_dir, "frame_timing")
     session_date_time = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
-    raw_data_path = None            # File where raw data will be written to
+    raw_data_paths = None           # Files where raw data will be written to, one per block
 
     # Determine the Settings for the Selected Training
     expected_wait_time = 0
@@ -69,64 +176,92 @@ def main():
         # Training Stage I Settings
         print("Training Stage 1 selected")
         expected_wait_time = 48     # 1 second trials for 8 targets (each displayed 6 times)
-        raw_data_path = os.path.join(script_dir, "Stage1RawData", f"{session_date_time}.txt")   # Raw data file saved in Stage1RawData directory
+        raw_data_paths = block_paths(os.path.join(script_dir, "Stage1RawData"), session_date_time, args.blocks)   # Raw data files saved in Stage1RawData directory
     elif args.train2:
         # Training Stage II Settings
         print("Training Stage 2 selected")
         expected_wait_time = 192    # 1 second trials for 32 targets (each displayed 6 times)
-        raw_data_path = os.path.join(script_dir, "Stage2RawData", f"{session_date_time}.txt")   # Raw data file saved in Stage2RawData directory
+        raw_data_paths = block_paths(os.path.join(script_dir, "Stage2RawData"), session_date_time, args.blocks)   # Raw data files saved in Stage2RawData directory
     
-    samples_to_collect = 250 * expected_wait_time   # 250 Hz Sampling Rate for Expected Time
-
     params = BrainFlowInputParams()     # BrainFlow Parameters Initialization
-    eeg_data = None
+    board_id = BoardIds.SYNTHETIC_BOARD if args.synthetic else BoardIds.CYTON_BOARD
+    sample_rate = BoardShim.get_sampling_rate(board_id.value)
+    samples_to_collect = sample_rate * expected_wait_time   # 250 Hz Sampling Rate for Expected Time
+    board = None
+    streaming = False
+    marker_receiver = None
+    ring_buffer = None
+    allocation_meter = AllocationMeter() if args.measure_allocations else None
+    control = SessionControlClient.from_environment("acquisition")    # Set when started by run_session.py
 
     try:
-        # Initialize BrainFlow Connection
-        params.serial_port = find_cyton_port()
-        board = BoardShim(BoardIds.CYTON_BOARD, params)
-        eeg_channels = board.get_eeg_channels(BoardIds.CYTON_BOARD.value)   # Channels from Cyton board for EEG
+        # Initialize BrainFlow Connection (once, however many blocks are recorded)
+        if not args.synthetic:
+            params.serial_port = find_cyton_port()
+        board = BoardShim(board_id, params)
+        eeg_channels = board.get_eeg_channels(board_id.value)   # Channels from Cyton board for EEG
+        timestamp_channel = board.get_timestamp_channel(board_id.value)
+        marker_channel = board.get_marker_channel(board_id.value)
         
         board.prepare_session()
         board.start_stream()        # begin to collect eeg data in the buffer
+        streaming = True
+
+        # Listen for Trial Onset Markers Sent by the Stimuli File (buffered until the recorder starts)
+        marker_receiver = MarkerReceiver(board)
+        # Publish the EEG rows and their timestamps for other processes (see shared_stream.py)
+        ring_buffer = SharedRingBuffer(len(eeg_channels) + 1, RING_BUFFER_SECONDS * sample_rate, sample_rate,
+                                       name=args.stream_name)
+
+        for block, raw_data_path in enumerate(raw_data_paths):
+            if len(raw_data_paths) > 1:
+                print(f"Block {block + 1} of {len(raw_data_paths)}")
+            if control is not None:
+                # run_session.py starts the stimuli and the recording at the same moment
+                control.ready()
+                control.wait_for_start()
+            else:
+                # Wait until Key-Press to Trigger Timer for Data Collection
+                # The Stimuli File will Also be Triggered Independently with this Same Key-Press
+                print("Hit \"enter/return\" to begin stimuli and data collection. Make sure to have the stimuli in focus.")
+                wait_for_enter()
 
-        # Wait until Key-Press to Trigger Timer for Data Collection
-        # The Stimuli File will Also be Triggered Independently with this Same Key-Press
-        print("Hit \"enter/return\" to begin stimuli and data collection. Make sure to have the stimuli in focus.")
-        wait_for_enter()
-        time.sleep(expected_wait_time)
+            # Stream samples_to_collect Samples to Disk in Small Chunks as They Arrive
+            writer = SessionWriter(raw_data_path, sample_rate, eeg_channels, start_time=time.time())
+            recorder = StreamingRecorder(board, writer, eeg_channels, timestamp_channel, marker_channel,
+                                         max_samples=samples_to_collect, ring_buffer=ring_buffer,
+                                         ring_rows=list(eeg_channels) + [timestamp_channel],
+                                         allocation_meter=allocation_meter)
+            first_event = len(marker_receiver.events)
+            recorder.start()
+            if block == 0:
+                marker_receiver.start()     # Insert markers only after the pre-session buffer has been discarded
+            recorder.join()
+            if allocation_meter is not None:
+                print("Board polls:", allocation_meter.summary())
 
-        # Get the Last samples_to_collect samples from the Cyton Board Buffer 
-        data = board.get_current_board_data(samples_to_collect, BrainFlowPresets.DEFAULT_PRESET)
-        eeg_data = data[eeg_channels]   # Get the specific EEG data
-        board.stop_stream()
-        board.release_session()
+            # The board keeps streaming while the block is saved, so the next block starts without reconnecting
+            finish_block(writer, raw_data_path, marker_receiver.events[first_event:], control,
+                         stimuli_indices_log, frame_timing_stem)
 
     except RuntimeError as e:
         print("USB Connection Error: ", e)
-        os._exit(1)
+        sys.exit(1)     # Unlike os._exit, runs the finally below so the board and every channel are released
     except Exception as e:
         print("Brainflow Error:", e)
-        os._exit(1)
+        sys.exit(1)
     finally:
-
-        time.sleep(1)   # Wait to ensure target display order has been logged
-
-        # Read the Targets from the Log into an Ordered List
-        stimuli_indices = []
-        with open(stimuli_indices_log, 'r') as file:
-            csv_reader = csv.reader(file)
-            for row in csv_reader:
-                for value in row:
-                    stimuli_indices.append(value)
-
-        # Write Raw Data to a File
-        eeg_data_transposed = eeg_data.T        # Transposesd eeg data
-        with open(raw_data_path, "w", newline='') as file:
-            writer = csv.writer(file)           # Write the ordered indices to the top of the file
-            writer.writerow(stimuli_indices)
-            for sample in eeg_data_transposed: # Write each sample as a new line (eeg channels are the columns)
-                writer.writerow(sample.tolist())
+        # Release whatever was opened, on success and on every error path
+        if marker_receiver is not None:
+            marker_receiver.stop()
+        if board is not None and board.is_prepared():
+            if streaming:
+                board.stop_stream()
+            board.release_session()
+        if ring_buffer is not None:
+            ring_buffer.close()
+        if control is not None:
+            control.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,80 @@
+import socket
+import struct
+import threading
+import time
+
+# Trial onset markers are sent from the stimuli file to the acquisition process
+# as single UDP datagrams on the loopback interface: trial number, target index
+# and the wall-clock time (seconds since the epoch) of the flip that showed it.
+MARKER_HOST = "127.0.0.1"
+MARKER_PORT = 50707
+_MARKER = struct.Struct("<iid")
+
+
+class MarkerSender:
+    '''
+    Send trial onset markers from the stimuli file.
+
+    Register `send` with `win.callOnFlip` so it runs immediately after the flip
+    that first shows the target; the flip time is then taken from the system
+    clock, which is the same clock BrainFlow timestamps samples with.
+    '''
+    def __init__(self, host=MARKER_HOST, port=MARKER_PORT):
+        self.address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, trial, target, flip_time=None):
+        '''
+        :param trial: index of the trial within the session
+        :param target: index of the target shown in this trial
+        :param flip_time: onset time in seconds since the epoch, defaults to now
+        '''
+        if flip_time is None:
+            flip_time = time.time()
+        self._socket.sendto(_MARKER.pack(trial, target, flip_time), self.address)
+
+    def close(self):
+        self._socket.close()
+
+
+class MarkerReceiver:
+    '''
+    Receive trial onset markers in the acquisition process and write them into
+    the board's marker channel with `board.insert_marker`.
+
+    BrainFlow reserves 0 for "no marker", so target i is inserted as i + 1. The
+    received (trial, target, flip_time) tuples are also kept in `events` so the
+    session file can store the exact flip times next to the marker channel.
+    '''
+    def __init__(self, board, host=MARKER_HOST, port=MARKER_PORT):
+        self.board = board
+        self.events = []
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((host, port))
+        self._socket.settimeout(0.1)     # Lets the thread notice `stop`
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._receive, name="marker-receive", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        '''
+        Stop receiving and close the socket, whether or not `start` was called.
+        '''
+        self._stop_event.set()
+        if self._thread.ident is not None:
+            self._thread.join()
+        self._socket.close()
+
+    def _receive(self):
+        while not self._stop_event.is_set():
+            try:
+                message = self._socket.recv(_MARKER.size)
+            except socket.timeout:
+                continue
+            if len(message) != _MARKER.size:
+                continue
+            trial, target, flip_time = _MARKER.unpack(message)
+            self.board.insert_marker(target + 1)
+            self.events.append((trial, target, flip_time))
@@ -0,0 +1,378 @@
+import argparse
+import json
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# Binary Session Layout
+#   8 bytes   magic
+#   4 bytes   format version (little-endian uint32)
+#   4 bytes   JSON header length in bytes (little-endian uint32)
+#   N bytes   UTF-8 JSON header, space-padded so the data block is 64-byte aligned
+#   float32   samples, channel-major (n_channels rows of n_samples)
+#   float64   per-sample timestamps (only if the header has "has_timestamps")
+#   float64   per-sample BrainFlow marker channel (only if the header has "has_markers")
+MAGIC = b"BRNOCLR\x00"
+FORMAT_VERSION = 1
+SESSION_EXTENSION = ".bin"
+DATA_ALIGNMENT = 64
+SAMPLE_DTYPE = np.dtype("<f4")
+TIMESTAMP_DTYPE = np.dtype("<f8")
+_PRELUDE = struct.Struct("<8sII")
+
+
+def _data_offset(header_length):
+    '''
+    Byte offset of the sample block for a JSON header of the given length.
+    '''
+    unpadded = _PRELUDE.size + header_length
+    return unpadded + (-unpadded % DATA_ALIGNMENT)
+
+
+def write_session(path, eeg_data, sample_rate, channel_ids, stimulus_indices, timestamps=None, start_time=None,
+                  markers=None, events=(), code_bank=None):
+    '''
+    Write an EEG session to the binary session format.
+
+    :param path: file to write
+    :param eeg_data: array of shape (channels, samples)
+    :param sample_rate: sampling rate of the board in Hz
+    :param channel_ids: board channel numbers of each row of eeg_data
+    :param stimulus_indices: ordered list of target indices shown during the session
+    :param timestamps: optional per-sample timestamps (seconds since the epoch)
+    :param start_time: session start time (seconds since the epoch), defaults to now
+    :param markers: optional per-sample marker channel (0 where no marker was inserted)
+    :param events: (trial, target, flip_time) tuples received from the stimuli file
+    :param code_bank: hash of the code bank the stimuli displayed, see Stimuli/Generic/codeBank.py
+    :returns dict: the header that was written
+    '''
+    eeg_data = np.ascontiguousarray(eeg_data, dtype=SAMPLE_DTYPE)
+    if eeg_data.ndim != 2 or eeg_data.shape[0] != len(channel_ids):
+        raise ValueError(f"Expected data of shape ({len(channel_ids)}, samples), got {eeg_data.shape}")
+    if timestamps is not None:
+        timestamps = np.ascontiguousarray(timestamps, dtype=TIMESTAMP_DTYPE)
+        if timestamps.shape != (eeg_data.shape[1],):
+            raise ValueError("Expected one timestamp per sample")
+    if markers is not None:
+        markers = np.ascontiguousarray(markers, dtype=TIMESTAMP_DTYPE)
+        if markers.shape != (eeg_data.shape[1],):
+            raise ValueError("Expected one marker value per sample")
+
+    header = _make_header(sample_rate, channel_ids, eeg_data.shape[1], stimulus_indices,
+                          timestamps is not None, start_time, markers is not None, events, code_bank)
+    with open(path, "wb") as file:
+        _write_header(file, header)
+        file.write(eeg_data.tobytes())
+        if timestamps is not None:
+            file.write(timestamps.tobytes())
+        if markers is not None:
+            file.write(markers.tobytes())
+    return header
+
+
+def _make_header(sample_rate, channel_ids, n_samples, stimulus_indices, has_timestamps, start_time=None,
+                 has_markers=False, events=(), code_bank=None):
+    '''
+    Build the JSON-serializable header of a session file.
+    '''
+    return {
+        "sample_rate": float(sample_rate),
+        "n_channels": len(channel_ids),
+        "n_samples": int(n_samples),
+        "channel_ids": [int(channel) for channel in channel_ids],
+        "stimulus_indices": [int(index) for index in stimulus_indices],
+        "start_time": float(time.time() if start_time is None else start_time),
+        "has_timestamps": bool(has_timestamps),
+        "has_markers": bool(has_markers),
+        "events": [[int(trial), int(target), float(flip_time)] for trial, target, flip_time in events],
+        "code_bank": code_bank,
+    }
+
+
+def _write_header(file, header):
+    '''
+    Write the prelude and padded JSON header, leaving the file positioned at
+    the start of the (aligned) sample block.
+    '''
+    encoded = json.dumps(header).encode("utf-8")
+    offset = _data_offset(len(encoded))
+    encoded = encoded.ljust(offset - _PRELUDE.size, b" ")
+    file.write(_PRELUDE.pack(MAGIC, FORMAT_VERSION, len(encoded)))
+    file.write(encoded)
+
+
+def read_header(path):
+    '''
+    Read the header of a binary session file without touching the samples.
+
+    :param path: session file to read
+    :returns dict: the session header, with the data block offset under "data_offset"
+    :raises ValueError: if the file is not a binary session file
+    '''
+    with open(path, "rb") as file:
+        prelude = file.read(_PRELUDE.size)
+        if len(prelude) != _PRELUDE.size:
+            raise ValueError(f"{path} is too short to be a session file")
+        magic, version, header_length = _PRELUDE.unpack(prelude)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a Brainoculars session file")
+        if version > FORMAT_VERSION:
+            raise ValueError(f"{path} uses session format version {version}, newest supported is {FORMAT_VERSION}")
+        header = json.loads(file.read(header_length).decode("utf-8"))
+    header["data_offset"] = _PRELUDE.size + header_length
+    return header
+
+
+def read_session(path, mode="r"):
+    '''
+    Open a binary session file as a memory-mapped view. Nothing is read from
+    disk until the returned array is sliced.
+
+    :param path: session file to open
+    :param mode: np.memmap mode, "r" for read-only or "r+" to edit in place
+    :returns tuple: the header dict and a (channels, samples) float32 np.memmap
+    '''
+    header = read_header(path)
+    shape = (header["n_channels"], header["n_samples"])
+    if shape[1] == 0:
+        return header, np.zeros(shape, dtype=SAMPLE_DTYPE)
+    data = np.memmap(path, dtype=SAMPLE_DTYPE, mode=mode, offset=header["data_offset"], shape=shape)
+    return header, data
+
+
+def _read_row(path, row):
+    '''
+    Memory-map one of the optional float64 rows stored after the samples.
+    '''
+    header = read_header(path)
+    if not header.get(f"has_{row}", False) or header["n_samples"] == 0:
+        return None
+    offset = header["data_offset"] + header["n_channels"] * header["n_samples"] * SAMPLE_DTYPE.itemsize
+    if row == "markers" and header["has_timestamps"]:
+        offset += header["n_samples"] * TIMESTAMP_DTYPE.itemsize
+    return np.memmap(path, dtype=TIMESTAMP_DTYPE, mode="r", offset=offset, shape=(header["n_samples"],))
+
+
+def read_timestamps(path):
+    '''
+    Open the per-sample timestamps of a binary session file.
+
+    :param path: session file to open
+    :returns np.memmap: float64 timestamps, or None if the session has none
+    '''
+    return _read_row(path, "timestamps")
+
+
+def read_markers(path):
+    '''
+    Open the per-sample marker channel of a binary session file. A non-zero
+    value at sample i means the stimuli file reported a trial onset there,
+    with the value being the target index plus one.
+
+    :param path: session file to open
+    :returns np.memmap: float64 marker values, or None if the session has none
+    '''
+    return _read_row(path, "markers")
+
+
+def read_trial_onsets(path, epoch_samples=1):
+    '''
+    Find the sample at which each trial started.
+
+    Flip times reported by the stimuli file are matched against the per-sample
+    timestamps when both were recorded; otherwise the non-zero entries of the
+    marker channel are used. Flips outside the recorded timestamps have no
+    onset sample and are dropped, as are trials cut short by the end of the recording.
+
+    :param path: session file to open
+    :param epoch_samples: samples that must be recorded from a trial's onset for it to be kept
+    :returns tuple: int arrays of onset sample indices and target indices, or None if the session has no markers
+    '''
+    header = read_header(path)
+    timestamps = read_timestamps(path)
+    if header.get("events") and timestamps is not None:
+        events = np.asarray(header["events"], dtype=np.float64)
+        events = events[(events[:, 2] >= timestamps[0]) & (events[:, 2] <= timestamps[-1])]
+        onsets = np.searchsorted(timestamps, events[:, 2])
+        targets = events[:, 1].astype(int)
+    else:
+        markers = read_markers(path)
+        if markers is None:
+            return None
+        onsets = np.flatnonzero(markers)
+        targets = markers[onsets].astype(int) - 1
+
+    complete = onsets + epoch_samples <= header["n_samples"]
+    return onsets[complete], targets[complete]
+
+
+class SessionWriter:
+    '''
+    Incrementally write a session while it is being recorded.
+
+    Samples are appended to a sample-major journal (``<path>.part``) and flushed
+    to disk after every chunk, so a crash loses at most the chunk being written.
+    `close` transposes the journal one channel at a time into the channel-major
+    session file, keeping memory use independent of the session length. A
+    journal left behind by a crash can be finalized with `recover_session`.
+    '''
+    def __init__(self, path, sample_rate, channel_ids, start_time=None):
+        self.path = path
+        self.journal_path = path + ".part"
+        self.header = _make_header(sample_rate, channel_ids, 0, [], True, start_time, has_markers=True)
+        self.n_samples = 0
+
+        with open(self.journal_path + ".json", "w") as file:
+            json.dump(self.header, file)
+        self._journal = open(self.journal_path, "wb")
+
+    def append(self, eeg_data, timestamps, markers=None):
+        '''
+        Append a chunk of samples and make it durable.
+
+        :param eeg_data: array of shape (channels, chunk_samples)
+        :param timestamps: array of shape (chunk_samples,)
+        :param markers: optional marker channel of shape (chunk_samples,)
+        '''
+        rows = np.empty((eeg_data.shape[1], self.header["n_channels"] + 2), dtype=TIMESTAMP_DTYPE)
+        rows[:, 0] = timestamps
+        rows[:, 1:-1] = np.asarray(eeg_data).T
+        rows[:, -1] = 0 if markers is None else markers
+        self._journal.write(rows.tobytes())
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.n_samples += rows.shape[0]
+
+    def close(self, stimulus_indices=(), events=(), code_bank=None):
+        '''
+        Finalize the session file and remove the journal.
+
+        :param stimulus_indices: ordered list of target indices shown during the session
+        :param events: (trial, target, flip_time) tuples received from the stimuli file
+        :param code_bank: hash of the code bank the stimuli displayed, if reported
+        :returns dict: the header that was written
+        '''
+        self._journal.close()
+        return _finalize_journal(self.path, self.journal_path, self.header, stimulus_indices, events, code_bank)
+
+
+def _finalize_journal(path, journal_path, header, stimulus_indices, events=(), code_bank=None):
+    '''
+    Transpose a sample-major journal into a channel-major session file.
+    '''
+    row_length = header["n_channels"] + 2      # timestamp, channels..., marker
+    n_samples = os.path.getsize(journal_path) // (row_length * TIMESTAMP_DTYPE.itemsize)   # Ignore a partially written last row
+    header = dict(header, n_samples=n_samples,
+                  stimulus_indices=[int(index) for index in stimulus_indices],
+                  events=[[int(trial), int(target), float(flip_time)] for trial, target, flip_time in events],
+                  code_bank=code_bank)
+
+    with open(path, "wb") as file:
+        _write_header(file, header)
+        if n_samples > 0:
+            journal = np.memmap(journal_path, dtype=TIMESTAMP_DTYPE, mode="r", shape=(n_samples, row_length))
+            for channel in range(1, header["n_channels"] + 1):
+                file.write(journal[:, channel].astype(SAMPLE_DTYPE).tobytes())
+            file.write(np.ascontiguousarray(journal[:, 0]).tobytes())
+            file.write(np.ascontiguousarray(journal[:, -1]).tobytes())
+            del journal
+
+    os.remove(journal_path)
+    os.remove(journal_path + ".json")
+    return header
+
+
+def recover_session(journal_path, stimulus_indices=()):
+    '''
+    Finalize the journal of a session whose recording was interrupted.
+
+    :param journal_path: the ``<path>.part`` file left behind by SessionWriter
+    :param stimulus_indices: ordered list of target indices, if known
+    :returns str: the path of the written session file
+    '''
+    with open(journal_path + ".json", "r") as file:
+        header = json.load(file)
+    path = journal_path[:-len(".part")]
+    _finalize_journal(path, journal_path, header, stimulus_indices)
+    return path
+
+
+def read_legacy_session(txt_path):
+    '''
+    Read a text session written by older versions of collect_training_data.py
+    (a row of stimulus indices followed by one comma-separated row per sample).
+
+    The body is parsed by NumPy's C parser straight into float32, from the same
+    open file as the header, so no float64 rows or per-value Python objects are
+    built along the way (np.genfromtxt is several times slower and larger).
+
+    :param txt_path: legacy .txt session file
+    :returns tuple: int array of stimulus indices and a C-contiguous (channels, samples) float32 array
+    '''
+    with open(txt_path, "r") as file:
+        first_line = file.readline().strip()
+        stimulus_indices = np.array([value for value in first_line.split(",") if value], dtype=np.int64)
+        samples = np.loadtxt(file, delimiter=",", dtype=np.float32, ndmin=2)
+    return stimulus_indices, np.ascontiguousarray(samples.T)    # Channel-major, like binary sessions
+
+
+def _convert_or_recover(session_path, sample_rate):
+    if session_path.endswith(".part"):
+        return f"Recovered {session_path} -> {recover_session(session_path)}"
+    return f"Converted {session_path} -> {convert_legacy_session(session_path, sample_rate=sample_rate)}"
+
+
+def convert_legacy_session(txt_path, bin_path=None, sample_rate=250):
+    '''
+    Convert a legacy text session into the binary session format.
+
+    :param txt_path: legacy .txt session file
+    :param bin_path: output file, defaults to txt_path with the session extension
+    :param sample_rate: sampling rate the session was recorded at
+    :returns str: the path of the written session file
+    '''
+    if bin_path is None:
+        bin_path = os.path.splitext(txt_path)[0] + SESSION_EXTENSION
+
+    stimulus_indices, eeg_data = read_legacy_session(txt_path)
+    channel_ids = list(range(1, eeg_data.shape[0] + 1))   # Cyton EEG channels are rows 1-8 of the board data
+
+    # Legacy files are named after their start time, e.g. 2025-02-26_14-46-27.txt
+    try:
+        start_time = time.mktime(time.strptime(os.path.basename(os.path.splitext(txt_path)[0]), "%Y-%m-%d_%H-%M-%S"))
+    except ValueError:
+        start_time = os.path.getmtime(txt_path)
+
+    write_session(bin_path, eeg_data, sample_rate, channel_ids, stimulus_indices, start_time=start_time)
+    return bin_path
+
+
+def main():
+    '''
+    Convert legacy .txt sessions (or every .txt session in the given directories)
+    into the binary session format, and finalize any interrupted ``.part`` journals.
+    '''
+    parser = argparse.ArgumentParser(description="Convert legacy text sessions to the binary session format")
+    parser.add_argument("paths", nargs="+", help="Legacy .txt files, .part journals or directories containing them")
+    parser.add_argument("--sample-rate", type=float, default=250, help="Sampling rate of the recordings in Hz")
+    parser.add_argument("--workers", type=int, help="Number of sessions to convert in parallel (defaults to the number of CPUs)")
+    args = parser.parse_args()
+
+    session_paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            session_paths += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith((".txt", ".part")))
+        else:
+            session_paths.append(path)
+
+    # Every session is independent, so historical sessions are converted in parallel processes
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for message in executor.map(_convert_or_recover, session_paths, [args.sample_rate] * len(session_paths)):
+            print(message)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+import time
+import tracemalloc
+
+import numpy as np
+
+
+class RingBuffer:
+    '''
+    Preallocated, channel-major ring buffer of the most recent samples.
+
+    The buffer is mirrored: it holds two copies of its `capacity` samples side
+    by side, and every sample is written to both halves. The last n samples
+    therefore always lie in one unbroken stretch of memory, so `window` returns
+    a NumPy view instead of copying or concatenating, and each channel's
+    window is contiguous. Writing costs two copies of the new samples; reading
+    costs nothing, however much the windows overlap.
+
+    Nothing is allocated after construction. Arrays that are allocated on the
+    way in (for example by `BoardShim.get_board_data`) can be measured with an
+    `AllocationMeter` around the code that feeds the buffer.
+    '''
+    def __init__(self, channels, capacity, dtype=np.float64, buffer=None):
+        '''
+        :param channels: number of channels, or a shape such as (bands, channels)
+        :param capacity: number of samples kept
+        :param dtype: sample type of the buffer
+        :param buffer: memory to keep the samples in (e.g. a shared memory segment), allocated if None
+        '''
+        self.shape = tuple(np.atleast_1d(channels))
+        self.capacity = capacity
+        if buffer is None:
+            self._data = np.zeros(self.shape + (2 * capacity,), dtype=dtype)
+        else:
+            self._data = np.ndarray(self.shape + (2 * capacity,), dtype=dtype, buffer=buffer)
+            self._data[:] = 0
+        self.position = 0           # Index in [0, capacity) the next sample is written to
+        self.samples_written = 0
+        self.largest_write = 0      # Most samples written at once, how far a write can reach past the newest sample
+        self.windows_read = 0
+        self._start = time.monotonic()
+
+    def __len__(self):
+        '''
+        :returns int: number of valid samples in the buffer
+        '''
+        return min(self.samples_written, self.capacity)
+
+    def write(self, samples, rows=None):
+        '''
+        Append samples, overwriting the oldest once the buffer is full.
+
+        :param samples: array of shape (..., channels, new_samples)
+        :param rows: rows of `samples` to store, e.g. the EEG channels of a board
+                     data array. They are copied row by row, so no temporary
+                     array is made for the selection.
+        '''
+        n = samples.shape[-1]
+        if n > self.capacity:       # Only the newest capacity samples can be kept
+            samples = samples[..., n - self.capacity:]
+            self.samples_written += n - self.capacity
+            n = self.capacity
+        first = min(n, self.capacity - self.position)
+        for start, stop, source in ((self.position, self.position + first, slice(0, first)),
+                                    (0, n - first, slice(first, n))):
+            if start == stop:
+                continue
+            for offset in (0, self.capacity):   # Both halves of the mirror
+                destination = self._data[..., start + offset:stop + offset]
+                if rows is None:
+                    np.copyto(destination, samples[..., source])
+                else:
+                    for i, row in enumerate(rows):
+                        np.copyto(destination[i], samples[row, source])
+        self.position = (self.position + n) % self.capacity
+        self.samples_written += n
+        self.largest_write = max(self.largest_write, n)
+
+    def window(self, n_samples):
+        '''
+        View of the newest samples, oldest first. The view is only valid until
+        the samples it shows are overwritten, so copy it to keep it longer.
+
+        :param n_samples: window length, at most `capacity`
+        :returns np.ndarray: read-only view of shape (..., channels, n_samples)
+        '''
+        if n_samples > len(self):
+            raise ValueError(f"Only {len(self)} samples are buffered, cannot return a window of {n_samples}")
+        end = self.position + self.capacity
+        view = self._data[..., end - n_samples:end]
+        view.flags.writeable = False
+        self.windows_read += 1
+        return view
+
+    def stats(self):
+        '''
+        :returns dict: samples written and windows read per second since construction
+        '''
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        return {
+            "samples_per_second": self.samples_written / elapsed,
+            "windows_per_second": self.windows_read / elapsed,
+        }
+
+
+class AllocationMeter:
+    '''
+    Measure the memory a hot path allocates, with `tracemalloc`. Wrap every call
+    in `with meter:`; the traced memory's peak above its level on entry is the
+    most the call held allocated at once, temporaries included. NumPy reports
+    its array buffers to tracemalloc, so arrays count whatever their size.
+
+    Blocks are counted by comparing tracemalloc snapshots taken on entry and
+    exit: a block counts if the call allocated it and still held it on return,
+    as tracemalloc keeps no record of blocks that were freed in between. The
+    rate divides them by the wall-clock time from the first call to the last.
+
+    Tracing is process-wide: allocations other threads make during a call are
+    counted too, and every allocation in the process is slowed down while the
+    meter exists, so only create one when measuring.
+    '''
+    def __init__(self):
+        self._started = not tracemalloc.is_tracing()
+        if self._started:
+            tracemalloc.start()
+        self.calls = 0
+        self.total_bytes = 0
+        self.max_bytes = 0
+        self.total_blocks = 0
+        self._entry = 0
+        self._peak = 0
+        self._snapshot = None
+        self._first_call = None
+        self._last_call = None
+
+    def __enter__(self):
+        if self._first_call is None:
+            self._first_call = time.perf_counter()
+        self._snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        self._entry = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, *exc_info):
+        # Only attributes are set before the snapshot, so the meter holds no more blocks than after the last call
+        self._peak = tracemalloc.get_traced_memory()[1]
+        self._last_call = time.perf_counter()
+        snapshot = tracemalloc.take_snapshot()
+        blocks = sum(max(stat.count_diff, 0) for stat in snapshot.compare_to(self._snapshot, "lineno")
+                     if stat.traceback[0].filename != tracemalloc.__file__)    # Not the snapshots' own bookkeeping
+        self._snapshot = None
+        allocated = max(self._peak - self._entry, 0)
+        self.calls += 1
+        self.total_bytes += allocated
+        self.max_bytes = max(self.max_bytes, allocated)
+        self.total_blocks += blocks
+        return False
+
+    def blocks_per_second(self):
+        '''
+        :returns float: blocks allocated per second of wall-clock time between the first and last call
+        '''
+        elapsed = self._last_call - self._first_call if self.calls else 0.0
+        return self.total_blocks / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        mean = self.total_bytes / self.calls if self.calls else 0
+        blocks = self.total_blocks / self.calls if self.calls else 0
+        return (f"{self.calls} calls, peak allocation {mean / 1024:.1f} KiB per call on average, "
+                f"{self.max_bytes / 1024:.1f} KiB at most, {self.blocks_per_second():.0f} blocks per second "
+                f"left allocated ({blocks:.1f} per call)")
+
+    def stop(self):
+        '''
+        Stop tracing, if this meter started it.
+        '''
+        if self._started and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._started = False
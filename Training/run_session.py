@@ -0,0 +1,134 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from session_control import CONTROL_ENV, SessionOrchestrator
+
+CHILD_POLL_INTERVAL = 1     # Seconds between checks that the children are still running while waiting on them
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+STIMULI = {
+    "train1": os.path.join(script_dir, "..", "Stimuli", "Stage1Training", "stage1train.py"),
+    "train2": os.path.join(script_dir, "..", "Stimuli", "Stage2Training", "stage2train.py"),
+}
+
+
+def file_args():
+    '''
+    Parse through the arguments for running this file.
+    Expected, mutually-exclusive arguments: --train1, --train2
+    Optional arguments: --synthetic, --blocks, --psychopy-python, --connect-timeout
+
+    :returns Namespace: the detected arguments
+    '''
+    parser = argparse.ArgumentParser(description="Run a training session: start the stimuli and the recording together")
+
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--train1", action="store_true", help="Choose training stage 1")
+    group.add_argument("--train2", action="store_true", help="Choose training stage 2")
+
+    parser.add_argument("--synthetic", action="store_true", help="Record from BrainFlow's synthetic board instead of the Cyton")
+    parser.add_argument("--blocks", type=int, default=1,
+                        help="Record this many blocks without reconnecting the board, each to its own file")
+    parser.add_argument("--psychopy-python", default=sys.executable,
+                        help="Python interpreter with PsychoPy installed, for the stimuli (defaults to this one)")
+    parser.add_argument("--connect-timeout", type=float, default=60,
+                        help="Seconds to wait for both processes to connect")
+    return parser.parse_args()
+
+
+def launch(args, port, role):
+    '''
+    Start the acquisition or stimulus process, pointed at the orchestrator's port.
+    The acquisition runs for every block; the stimulus is started once per block.
+
+    :returns subprocess.Popen: the started process
+    '''
+    stage = "train1" if args.train1 else "train2"
+    env = dict(os.environ, **{CONTROL_ENV: str(port)})
+    if role == "acquisition":
+        command = [sys.executable, os.path.join(script_dir, "collect_training_data.py"), f"--{stage}",
+                   "--blocks", str(args.blocks)]
+        if args.synthetic:
+            command.append("--synthetic")
+        return subprocess.Popen(command, env=env)
+    return subprocess.Popen([args.psychopy_python, STIMULI[stage]], env=env, cwd=os.path.dirname(STIMULI[stage]))
+
+
+def accept(orchestrator, processes, timeout):
+    '''
+    Wait until every child has connected, giving up as soon as one of them exits.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        for role, process in processes.items():
+            if process.poll() is not None:
+                raise RuntimeError(f"The {role} process exited with code {process.returncode} before connecting")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"The processes did not connect within {timeout:g} s")
+        try:
+            return orchestrator.accept(timeout=min(CHILD_POLL_INTERVAL, remaining))
+        except TimeoutError:
+            continue
+
+
+def wait_for(orchestrator, processes, role, message_type):
+    '''
+    Wait for a message from a child, giving up if that child exits without sending it.
+
+    :returns dict: the message
+    '''
+    while True:
+        try:
+            return orchestrator.expect(role, message_type, timeout=CHILD_POLL_INTERVAL)
+        except TimeoutError:
+            if processes[role].poll() is not None:
+                raise RuntimeError(f"The {role} process exited before sending {message_type}") from None
+
+
+def main():
+    args = file_args()
+    orchestrator = SessionOrchestrator(("acquisition", "stimulus"))
+    launched = time.monotonic()
+    processes = {role: launch(args, orchestrator.port, role) for role in orchestrator.roles}
+
+    try:
+        for block in range(args.blocks):
+            if block > 0:
+                # The board stays connected; only the stimuli are restarted for the next block
+                processes["stimulus"].wait()
+                orchestrator.forget("stimulus")
+                launched = time.monotonic()
+                processes["stimulus"] = launch(args, orchestrator.port, "stimulus")
+            accept(orchestrator, processes, args.connect_timeout)
+            for role, (offset, round_trip) in orchestrator.measure_offsets().items():
+                print(f"{role}: clock offset {offset * 1000:+.3f} ms, round trip {round_trip * 1000:.3f} ms")
+
+            # Release both processes at one start time once the board is streaming and the stimuli are on screen
+            for role in orchestrator.roles:
+                wait_for(orchestrator, processes, role, "ready")
+            orchestrator.start()
+            print(f"Block {block + 1} of {args.blocks} started {time.monotonic() - launched:.1f} s after launch")
+
+            # The trial log goes straight from the stimuli to the recording, no log file to race on
+            trials = wait_for(orchestrator, processes, "stimulus", "trials")
+            orchestrator.send("acquisition", trials)
+            done = wait_for(orchestrator, processes, "acquisition", "done")
+            print(f"Block {block + 1} saved to {done['session']} with {len(trials['targets'])} trials")
+    except (RuntimeError, TimeoutError, ConnectionError, OSError) as e:
+        print("Session failed:", e)
+        for process in processes.values():
+            if process.poll() is None:
+                process.terminate()
+        sys.exit(1)
+    finally:
+        for process in processes.values():
+            process.wait()
+        orchestrator.close()
+
+
+if __name__ == '__main__':
+    main()
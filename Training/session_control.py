@@ -0,0 +1,256 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+# A session started by run_session.py is coordinated over one loopback TCP
+# connection per child process, carrying one JSON message per line:
+#   child -> orchestrator        {"type": "hello", "role": ...}
+#   orchestrator -> child        {"type": "ping", "time": ...}, answered with
+#   child -> orchestrator        {"type": "pong", "time": ..., "child_time": ...}
+#   child -> orchestrator        {"type": "ready"}, once it can start at short notice
+#   orchestrator -> child        {"type": "start", "start_time": ...}, in the child's clock
+#   stimulus -> orchestrator     {"type": "trials", "targets": [...], "code_bank": ...}, relayed to the acquisition
+#   acquisition -> orchestrator  {"type": "done", "session": ...}
+# With several blocks a new stimulus process connects for every block, while
+# the acquisition stays connected and repeats ready/start/trials/done per block.
+# The children find the orchestrator through the CONTROL_ENV environment variable.
+CONTROL_HOST = "127.0.0.1"
+CONTROL_ENV = "BRAINOCULARS_CONTROL_PORT"
+START_DELAY = 0.5           # Seconds between the start message and the common start time
+
+
+class _Channel:
+    '''
+    Newline-delimited JSON messages over a connected socket.
+    '''
+    def __init__(self, connection):
+        self._socket = connection
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = connection.makefile("r", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + "\n").encode("utf-8")
+        with self._lock:
+            self._socket.sendall(data)
+
+    def receive(self):
+        '''
+        :returns dict: the next message, or None once the other side has closed the connection
+        '''
+        line = self._reader.readline()
+        return json.loads(line) if line else None
+
+    def close(self):
+        # Shutting down wakes a thread blocked in `receive`; closing the reader under it would deadlock
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+
+
+class SessionControlClient:
+    '''
+    The child-process side of a session: answers clock pings, reports when it
+    is ready and learns the common start time and the trial log. Start times
+    and trial logs are queued, so a process recording several blocks takes
+    one of each per block.
+    '''
+    def __init__(self, role, port, host=CONTROL_HOST):
+        '''
+        :param role: "acquisition" or "stimulus"
+        :param port: port the orchestrator listens on
+        '''
+        self.role = role
+        self.start_time = None
+        self._start_times = queue.Queue()
+        self._trials = queue.Queue()
+        self._channel = _Channel(socket.create_connection((host, port)))
+        self._channel.send({"type": "hello", "role": role})
+        self._thread = threading.Thread(target=self._receive, name="session-control", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_environment(cls, role):
+        '''
+        :returns SessionControlClient: a client if this process was started by run_session.py, otherwise None
+        '''
+        port = os.environ.get(CONTROL_ENV)
+        return None if port is None else cls(role, int(port))
+
+    def _receive(self):
+        while True:
+            message = self._channel.receive()
+            if message is None:
+                return
+            if message["type"] == "ping":
+                self._channel.send({"type": "pong", "time": message["time"], "child_time": time.time()})
+            elif message["type"] == "start":
+                self.start_time = message["start_time"]
+                self._start_times.put(message["start_time"])
+            elif message["type"] == "trials":
+                self._trials.put((message["targets"], message.get("code_bank")))
+
+    def ready(self):
+        '''
+        Tell the orchestrator this process can start as soon as it is told to.
+        '''
+        self._channel.send({"type": "ready"})
+
+    def started(self):
+        '''
+        Non-blocking check for use inside a frame loop.
+
+        :returns bool: True once the common start time has passed
+        '''
+        return self.start_time is not None and time.time() >= self.start_time
+
+    def wait_for_start(self):
+        '''
+        Block until the next common start time.
+        '''
+        start_time = self._start_times.get()
+        time.sleep(max(0.0, start_time - time.time()))
+
+    def send_trials(self, targets, code_bank=None):
+        '''
+        Send the targets shown in this session, in order, and the hash of the code bank they showed.
+        '''
+        self._channel.send({"type": "trials", "targets": [int(target) for target in targets], "code_bank": code_bank})
+
+    def wait_for_trials(self, timeout=None):
+        '''
+        :returns tuple: the targets shown in the next block and the hash of their code bank (None if
+                        not reported), or None if they did not arrive in time
+        '''
+        try:
+            return self._trials.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def done(self, **info):
+        '''
+        Report that this process has finished, with anything the orchestrator should print.
+        '''
+        self._channel.send(dict(info, type="done"))
+
+    def close(self):
+        self._channel.close()
+
+
+class SessionOrchestrator:
+    '''
+    The orchestrator side: accepts one connection per role, measures each
+    child's clock offset, releases every child at one common start time once
+    all are ready and relays messages between them.
+    '''
+    def __init__(self, roles, host=CONTROL_HOST, port=0):
+        self.roles = tuple(roles)
+        self.offsets = {}           # role -> (child clock - orchestrator clock, round trip) in seconds
+        self._server = socket.create_server((host, port))
+        self.port = self._server.getsockname()[1]
+        self._channels = {}
+        self._messages = queue.Queue()
+        self._pending = []
+
+    def accept(self, timeout=None):
+        '''
+        Wait until every role has connected.
+        '''
+        self._server.settimeout(timeout)
+        while len(self._channels) < len(self.roles):
+            channel = _Channel(self._server.accept()[0])
+            hello = channel.receive()
+            if hello is None or hello.get("role") not in self.roles or hello["role"] in self._channels:
+                channel.close()
+                continue
+            self._channels[hello["role"]] = channel
+            threading.Thread(target=self._receive, args=(hello["role"], channel), daemon=True).start()
+
+    def forget(self, role):
+        '''
+        Drop a role's connection so a new process can take its place with `accept`,
+        e.g. the stimulus process of the next block. Its remaining messages are discarded.
+        '''
+        self._channels.pop(role).close()
+        self.offsets.pop(role, None)
+
+    def _receive(self, role, channel):
+        while True:
+            message = channel.receive()
+            self._messages.put((role, channel, message if message is not None else {"type": "closed"}))
+            if message is None:
+                return
+
+    def expect(self, role, message_type, timeout=None):
+        '''
+        Wait for a message of a type from a role, keeping any others for later.
+
+        :returns dict: the message
+        :raises TimeoutError: if it does not arrive in time
+        :raises ConnectionError: if the role disconnects first
+        '''
+        self._pending = [(sender, channel, message) for sender, channel, message in self._pending
+                         if self._channels.get(sender) is channel]  # Drop what forgotten connections sent
+        for i, (sender, _, message) in enumerate(self._pending):
+            if sender == role and message["type"] == message_type:
+                return self._pending.pop(i)[2]
+            if sender == role and message["type"] == "closed":
+                raise ConnectionError(f"The {role} process disconnected before sending {message_type}")
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                sender, channel, message = self._messages.get(timeout=remaining)
+            except queue.Empty:
+                raise TimeoutError(f"No {message_type} message from the {role} process") from None
+            if self._channels.get(sender) is not channel:
+                continue
+            if sender == role and message["type"] == message_type:
+                return message
+            self._pending.append((sender, channel, message))
+            if sender == role and message["type"] == "closed":
+                raise ConnectionError(f"The {role} process disconnected before sending {message_type}")
+
+    def measure_offsets(self, n_pings=10):
+        '''
+        Estimate every child's clock offset from the ping with the shortest round trip.
+
+        :returns dict: role -> (offset, round trip) in seconds
+        '''
+        for role, channel in self._channels.items():
+            best = None
+            for _ in range(n_pings):
+                channel.send({"type": "ping", "time": time.time()})
+                pong = self.expect(role, "pong", timeout=5)
+                received = time.time()
+                round_trip = received - pong["time"]
+                offset = pong["child_time"] - (pong["time"] + received) / 2
+                if best is None or round_trip < best[1]:
+                    best = (offset, round_trip)
+            self.offsets[role] = best
+        return self.offsets
+
+    def start(self, delay=START_DELAY):
+        '''
+        Release every child at one start time, `delay` seconds from now.
+
+        :returns float: the start time on the orchestrator's clock
+        '''
+        start_time = time.time() + delay
+        for role, channel in self._channels.items():
+            offset = self.offsets.get(role, (0.0, 0.0))[0]
+            channel.send({"type": "start", "start_time": start_time + offset})
+        return start_time
+
+    def send(self, role, message):
+        self._channels[role].send(message)
+
+    def close(self):
+        for channel in self._channels.values():
+            channel.close()
+        self._server.close()
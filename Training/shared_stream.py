@@ -0,0 +1,168 @@
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from ring_buffer import RingBuffer
+
+# The acquisition process publishes its samples in a shared memory segment:
+# a header of int64 fields followed by a mirrored RingBuffer of float64 rows
+# (the EEG channels, then the sample timestamps). The writer bumps SEQUENCE,
+# the total number of samples written, after the samples themselves are in
+# place. Readers only read, so any number of them cost the writer nothing.
+STREAM_NAME = "brainoculars_eeg"
+STREAM_VERSION = 1
+_MAGIC = 0x42524E4F43554C52
+HEADER_BYTES = 64
+MAGIC, VERSION, ROWS, CAPACITY, SAMPLE_RATE, SEQUENCE, LARGEST_WRITE, CLOSED = range(8)
+
+
+def _attach(name):
+    '''
+    Open an existing segment without taking ownership of it. Python < 3.13
+    registers every opened segment with the resource tracker, which would
+    unlink it when a reader exits, so readers unregister it again.
+    '''
+    segment = shared_memory.SharedMemory(name=name)
+    resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+class SharedRingBuffer(RingBuffer):
+    '''
+    A `RingBuffer` in a named shared memory segment, written by the acquisition
+    process and read by any number of `SharedStreamReader`s in other processes.
+    '''
+    def __init__(self, rows, capacity, sample_rate, name=STREAM_NAME):
+        '''
+        :param rows: number of rows published (EEG channels plus the timestamp row)
+        :param capacity: number of samples kept
+        :param sample_rate: sample rate of the stream, stored for readers
+        :param name: name of the shared memory segment
+        '''
+        size = HEADER_BYTES + rows * 2 * capacity * np.dtype(np.float64).itemsize
+        try:
+            self._segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:     # Left behind by a session that crashed
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self._segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = name
+        super().__init__(rows, capacity, buffer=self._segment.buf[HEADER_BYTES:])
+        self._header = np.ndarray(HEADER_BYTES // 8, dtype=np.int64, buffer=self._segment.buf)
+        self._header[:] = 0
+        self._header[[MAGIC, VERSION, ROWS, CAPACITY, SAMPLE_RATE]] = [_MAGIC, STREAM_VERSION, rows, capacity,
+                                                                       int(sample_rate)]
+
+    def write(self, samples, rows=None):
+        super().write(samples, rows)
+        self._header[LARGEST_WRITE] = self.largest_write
+        self._header[SEQUENCE] = self.samples_written    # Published only once the samples are in place
+
+    def close(self):
+        '''
+        Tell readers the stream has ended and remove the segment. Readers that
+        are still attached keep their mapping until they close it.
+        '''
+        self._header[CLOSED] = 1
+        self._data = self._header = None
+        try:
+            self._segment.close()
+        except BufferError:         # A window view is still alive in this process
+            pass
+        self._segment.unlink()
+
+
+class SharedStreamReader:
+    '''
+    Consume the stream published by a `SharedRingBuffer` in another process.
+
+    Every reader keeps its own position, so a decoder, a live scope and a
+    recorder can all follow the same stream. Reads return read-only views of
+    the shared samples, without copying or deserializing. A view is valid
+    until the writer laps it; `lapped` tells whether that may have happened.
+    '''
+    def __init__(self, name=STREAM_NAME):
+        '''
+        :param name: name of the shared memory segment
+        :raises FileNotFoundError: if no stream of that name is being published
+        '''
+        self._segment = _attach(name)
+        self._header = np.ndarray(HEADER_BYTES // 8, dtype=np.int64, buffer=self._segment.buf)
+        if self._header[MAGIC] != _MAGIC or self._header[VERSION] != STREAM_VERSION:
+            self.close()
+            raise ValueError(f"Shared memory segment {name} does not hold a version {STREAM_VERSION} EEG stream")
+        self.rows = int(self._header[ROWS])
+        self.capacity = int(self._header[CAPACITY])
+        self.sample_rate = int(self._header[SAMPLE_RATE])
+        self._data = np.ndarray((self.rows, 2 * self.capacity), dtype=np.float64,
+                                buffer=self._segment.buf[HEADER_BYTES:])
+        self._data.flags.writeable = False
+        self.cursor = int(self._header[SEQUENCE])   # Start from the newest sample
+        self.dropped = 0            # Samples overwritten before this reader got to them
+        self._last_read = (self.cursor, 0)
+
+    @property
+    def closed(self):
+        return bool(self._header[CLOSED])
+
+    @property
+    def available(self):
+        '''
+        :returns int: samples published since the last read
+        '''
+        return int(self._header[SEQUENCE]) - self.cursor
+
+    def _view(self, sequence, n_samples):
+        end = sequence % self.capacity + self.capacity
+        self._last_read = (sequence, n_samples)
+        return self._data[:, end - n_samples:end]
+
+    def read(self):
+        '''
+        Samples published since the last read. If the reader fell more than
+        `capacity` samples behind, the oldest are skipped and counted in `dropped`.
+
+        :returns np.ndarray: read-only view of shape (rows, new_samples)
+        '''
+        sequence = int(self._header[SEQUENCE])
+        n = sequence - self.cursor
+        if n > self.capacity:
+            self.dropped += n - self.capacity
+            n = self.capacity
+        self.cursor = sequence
+        return self._view(sequence, n)
+
+    def window(self, n_samples):
+        '''
+        The newest samples, whether or not they have been read.
+
+        :param n_samples: window length, at most `capacity`
+        :returns np.ndarray: read-only view of shape (rows, n_samples)
+        '''
+        sequence = int(self._header[SEQUENCE])
+        if n_samples > min(sequence, self.capacity):
+            raise ValueError(f"Only {min(sequence, self.capacity)} samples are buffered")
+        return self._view(sequence, n_samples)
+
+    def lapped(self):
+        '''
+        Whether the writer may have overwritten part of the last view returned,
+        including a write still in progress. Check after using a view that was
+        held for a while; a reader that keeps up never sees this.
+
+        :returns bool: True if the last view can no longer be trusted
+        '''
+        sequence, n_samples = self._last_read
+        reach = int(self._header[SEQUENCE]) + int(self._header[LARGEST_WRITE]) - sequence
+        return reach > self.capacity - n_samples
+
+    def close(self):
+        '''
+        Detach from the stream. Views returned earlier must not be used afterwards.
+        '''
+        self._data = self._header = None
+        try:
+            self._segment.close()
+        except BufferError:         # A view is still alive; the mapping goes when it does
+            pass
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import time
+import unittest
+
+import numpy as np
+from brainflow.board_shim import BoardShim, BrainFlowInputParams, BoardIds
+
+from acquisition import StreamingRecorder
+from raw_data import SESSION_EXTENSION, SessionWriter, read_markers, read_session, read_timestamps, recover_session
+
+RECORD_SECONDS = 3
+
+
+class SyntheticBoardRecordingTest(unittest.TestCase):
+    '''
+    Record a few seconds from BrainFlow's synthetic board, the way
+    collect_training_data.py --synthetic does, and check what reaches disk.
+    '''
+    @classmethod
+    def setUpClass(cls):
+        BoardShim.disable_board_logger()
+        board_id = BoardIds.SYNTHETIC_BOARD.value
+        cls.sample_rate = BoardShim.get_sampling_rate(board_id)
+        cls.eeg_channels = BoardShim.get_eeg_channels(board_id)
+        cls.timestamp_channel = BoardShim.get_timestamp_channel(board_id)
+        cls.marker_channel = BoardShim.get_marker_channel(board_id)
+        cls.board = BoardShim(board_id, BrainFlowInputParams())
+        cls.board.prepare_session()
+        cls.board.start_stream()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.board.stop_stream()
+        cls.board.release_session()
+        del cls.board           # BoardShim.__del__ fails if left to run at interpreter shutdown
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "session" + SESSION_EXTENSION)
+        self.n_samples = RECORD_SECONDS * self.sample_rate
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record(self):
+        '''
+        :returns SessionWriter: the writer the samples went to, not yet closed
+        '''
+        writer = SessionWriter(self.path, self.sample_rate, self.eeg_channels, start_time=time.time())
+        recorder = StreamingRecorder(self.board, writer, self.eeg_channels, self.timestamp_channel,
+                                     self.marker_channel, max_samples=self.n_samples)
+        start = time.monotonic()
+        recorder.start()
+        self.board.insert_marker(1)
+        self.assertTrue(recorder.join(timeout=RECORD_SECONDS * 5))
+        self.assertGreater(time.monotonic() - start, RECORD_SECONDS * 0.5)   # Samples arrive in real time
+        self.assertEqual(recorder.samples_recorded, self.n_samples)
+        return writer
+
+    def check_session(self, path):
+        header, data = read_session(path)
+        self.assertEqual(header["n_samples"], self.n_samples)
+        self.assertEqual(data.shape, (len(self.eeg_channels), self.n_samples))
+
+        timestamps = read_timestamps(path)
+        self.assertEqual(len(timestamps), self.n_samples)
+        self.assertTrue(np.all(np.diff(timestamps) > 0))
+        # The synthetic board stamps every sample, so the span matches the sample count
+        self.assertAlmostEqual(timestamps[-1] - timestamps[0], (self.n_samples - 1) / self.sample_rate,
+                               delta=RECORD_SECONDS * 0.2)
+        self.assertEqual(np.count_nonzero(read_markers(path)), 1)
+
+    def test_record(self):
+        writer = self.record()
+        writer.close(stimulus_indices=[0])
+        self.assertFalse(os.path.exists(writer.journal_path))
+        self.check_session(self.path)
+
+    def test_recover_journal(self):
+        writer = self.record()
+        # Stop as a crash would: the journal is left behind with half a row written after the last chunk
+        writer._journal.write(b"\0" * 5)
+        writer._journal.close()
+        self.assertFalse(os.path.exists(self.path))
+
+        self.assertEqual(recover_session(writer.journal_path), self.path)
+        self.assertFalse(os.path.exists(writer.journal_path))
+        self.check_session(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
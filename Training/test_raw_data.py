@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from raw_data import SESSION_EXTENSION, read_trial_onsets, write_session
+
+SAMPLE_RATE = 250
+
+
+class TrialOnsetTest(unittest.TestCase):
+    '''
+    Match the flip times the stimuli report against the recorded timestamps.
+    '''
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "session" + SESSION_EXTENSION)
+        self.n_samples = 4 * SAMPLE_RATE
+        self.timestamps = 1000 + np.arange(self.n_samples) / SAMPLE_RATE
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, flip_times):
+        events = [(trial, trial % 8, flip_time) for trial, flip_time in enumerate(flip_times)]
+        write_session(self.path, np.zeros((8, self.n_samples)), SAMPLE_RATE, list(range(1, 9)),
+                      [target for _, target, _ in events], timestamps=self.timestamps, events=events)
+
+    def test_onsets(self):
+        self.write(self.timestamps[[10, 260, 510]])
+        onsets, targets = read_trial_onsets(self.path)
+        np.testing.assert_array_equal(onsets, [10, 260, 510])
+        np.testing.assert_array_equal(targets, [0, 1, 2])
+
+    def test_flip_before_first_sample(self):
+        # The first flip can land a few milliseconds before the recorder's first sample
+        self.write([self.timestamps[0] - 0.002, self.timestamps[260], self.timestamps[510]])
+        onsets, targets = read_trial_onsets(self.path)
+        np.testing.assert_array_equal(onsets, [260, 510])
+        np.testing.assert_array_equal(targets, [1, 2])
+
+    def test_flip_after_last_sample(self):
+        self.write([self.timestamps[10], self.timestamps[-1] + 0.01])
+        onsets, targets = read_trial_onsets(self.path)
+        np.testing.assert_array_equal(onsets, [10])
+        np.testing.assert_array_equal(targets, [0])
+
+    def test_epoch_past_end(self):
+        self.write(self.timestamps[[10, self.n_samples - SAMPLE_RATE, self.n_samples - SAMPLE_RATE + 1]])
+        onsets, _ = read_trial_onsets(self.path, epoch_samples=SAMPLE_RATE)
+        np.testing.assert_array_equal(onsets, [10, self.n_samples - SAMPLE_RATE])
+
+
+if __name__ == '__main__':
+    unittest.main()